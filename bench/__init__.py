@@ -0,0 +1 @@
+"""Офлайн-бенчмарки пайплайна на синтетических данных и заглушках VK/Яндекса."""
@@ -0,0 +1,119 @@
+"""
+Сравнение последовательного и параллельного сбора пользователей на заглушке VK
+(сборщик пайплайна — pipeline.stream_users).
+С --query — ещё и сбор с фильтрами запроса, применёнными к страницам участников.
+С --resume — сбор, прерванный после --fail-after вызовов API и продолженный
+с чекпоинта, и повторный сбор с индексом уже обработанных пользователей.
+
+    python -m bench.collector --n-target 100 --tokens 2 --workers 8
+    python -m bench.collector --query "пенсионерки Екатеринбург"
+    python -m bench.collector --resume --n-target 300 --fail-after 6
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+import vk_utils
+from bench.fake_vk import FAKE_CITIES, FakeVkSession, QuotaExceeded
+from harvest_state import SeenIndex, checkpoint_path
+from pipeline import collect_users
+
+
+def run_collector(n_target, workers, n_tokens, latency, rate_limit, query=None, prefilter=True):
+    """prefilter=False — фильтры запроса применяются только к уже собранным (как раньше)."""
+    sessions = [FakeVkSession(latency=latency, rate_limit=rate_limit, seed=i) for i in range(n_tokens)]
+    api = vk_utils.VkApiPool(sessions, rate=rate_limit)
+    predicate = None
+    if query:
+        import pandas as pd
+        from filtering import SEX_LABELS, filter_members, parse_query_filters, query_mask
+
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            filters = parse_query_filters(query, FAKE_CITIES)
+        if prefilter:
+            predicate = lambda members: filter_members(members, filters)
+    start = time.perf_counter()
+    users = collect_users([1, 2, 3], n_target, workers=workers, api=api, predicate=predicate)
+    elapsed = time.perf_counter() - start
+    matching = len(users)
+    if query and users:
+        df = pd.DataFrame(users)
+        df['sex'] = df['sex'].map(SEX_LABELS)
+        matching = int(query_mask(query, df, filters).sum())
+    api_calls = sum(s.calls for s in sessions)
+    return {
+        'query': query,
+        'prefilter': bool(predicate),
+        'workers': workers,
+        'tokens': n_tokens,
+        'users': len(users),
+        'matching': matching,
+        'calls_per_matching': round(api_calls / matching, 2) if matching else None,
+        'seconds': round(elapsed, 3),
+        'users_per_sec': round(len(users) / elapsed, 2) if elapsed else None,
+        'api_calls': api_calls,
+        'rate_errors': sum(s.rate_errors for s in sessions),
+    }
+
+
+def run_resume(n_target, workers, fail_after, groups=(1, 2, 3)):
+    """Вызовы API: сбор без прерывания; прерванный + продолженный; повторный с тем же индексом."""
+    def collect(fail_after=None, **kwargs):
+        session = FakeVkSession(latency=0, rate_limit=0, fail_after=fail_after)
+        api = vk_utils.VkApiPool([session], rate=1000)
+        users = []
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            try:
+                collect_users(list(groups), n_target, users, workers=workers, api=api, **kwargs)
+            except QuotaExceeded:
+                pass
+        return session.calls, users
+
+    baseline_calls, _ = collect()
+    with tempfile.TemporaryDirectory() as workdir:
+        checkpoint = checkpoint_path(list(groups), n_target, directory=workdir)
+        seen_dir = os.path.join(workdir, 'seen')
+        failed_calls, before = collect(fail_after, seen=SeenIndex(seen_dir), checkpoint=checkpoint)
+        resumed_calls, after = collect(seen=SeenIndex(seen_dir), checkpoint=checkpoint)
+        _, again = collect(seen=SeenIndex(seen_dir))
+    users = {u['user_id'] for u in before + after}
+    return {
+        'n_target': n_target,
+        'baseline_calls': baseline_calls,
+        'interrupted_calls': failed_calls,
+        'resumed_calls': resumed_calls,
+        'resumed_users': len(users),
+        'duplicate_users_after_resume': len(before) + len(after) - len(users),
+        'repeated_users_next_run': len(users & {u['user_id'] for u in again}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-target', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--tokens', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--rate-limit', type=int, default=3)
+    parser.add_argument('--query', default=None, help='запрос, фильтры которого применяются до запроса подписок')
+    parser.add_argument('--resume', action='store_true', help='прерванный сбор с чекпоинтом и индексом пользователей')
+    parser.add_argument('--fail-after', type=int, default=6, help='вызовов API до «исчерпания квоты» (с --resume)')
+    args = parser.parse_args()
+
+    if args.resume:
+        print(run_resume(args.n_target, args.workers, args.fail_after))
+        return
+
+    if args.query:
+        for prefilter in (False, True):
+            print(run_collector(args.n_target, args.workers, args.tokens, args.latency, args.rate_limit,
+                                args.query, prefilter))
+        return
+    print(run_collector(args.n_target, 1, 1, args.latency, args.rate_limit))
+    print(run_collector(args.n_target, args.workers, args.tokens, args.latency, args.rate_limit))
+
+
+if __name__ == '__main__':
+    main()
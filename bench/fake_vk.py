@@ -0,0 +1,127 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import vk_api
+
+# справочник городов для database.getCities
+FAKE_CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Казань', 'Казанская', 'Нижний Новгород', 'Новгород']
+
+
+class QuotaExceeded(RuntimeError):
+    """Сессия исчерпала fail_after вызовов — как обрыв сбора на суточной квоте."""
+
+
+class FakeVkSession:
+    """
+    Заглушка vk_api.VkApi: метод method(name, values) с искусственной
+    задержкой и лимитом запросов в секунду (как у VK — ошибка 6 при превышении).
+    Как и vk_api.VkApi, держит блокировку сессии на время запроса: запросы
+    по одному токену не перекрываются.
+    Ответы детерминированы: зависят только от seed и id группы/пользователя.
+    fail_after — после стольких вызовов method() бросает QuotaExceeded.
+    """
+
+    def __init__(self, latency=0.05, rate_limit=3, private_ratio=0.3,
+                 dead_ratio=0.15, group_size=50_000, group_ids=None, seed=0, fail_after=None):
+        self.latency = latency
+        self.fail_after = fail_after
+        self.rate_limit = rate_limit
+        self.private_ratio = private_ratio
+        self.dead_ratio = dead_ratio
+        self.group_size = group_size
+        self.group_ids = [int(g) for g in group_ids] if group_ids is not None else list(range(1, 10_001))
+        self.seed = seed
+        self.calls = 0
+        self.rate_errors = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self.lock = threading.Lock()    # как VkApi.lock: один запрос на сессию за раз
+
+    def _error(self, name, values, code, msg):
+        return vk_api.exceptions.ApiError(self, name, values, False,
+                                          {'error_code': code, 'error_msg': msg})
+
+    def _check_rate(self, name, values):
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1.0:
+                self._recent.popleft()
+            if self.rate_limit and len(self._recent) >= self.rate_limit:
+                self.rate_errors += 1
+                raise self._error(name, values, 6, 'Too many requests per second')
+            self._recent.append(now)
+
+    def _user(self, user_id):
+        rng = random.Random(self.seed * 1_000_003 + user_id)
+        u = {'id': user_id, 'sex': rng.choice([1, 2])}
+        roll = rng.random()
+        if roll < self.dead_ratio / 2:
+            u['deactivated'] = 'deleted'
+        elif roll < self.dead_ratio:
+            u['is_closed'] = True
+            u['can_access_closed'] = False
+        if rng.random() < 0.7:
+            u['bdate'] = f"{rng.randint(1, 28)}.{rng.randint(1, 12)}.{rng.randint(1950, 2010)}"
+        u['city'] = {'id': 1, 'title': rng.choice(['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Казань'])}
+        u['country'] = {'id': 1, 'title': 'Россия'}
+        return u
+
+    def _get_members(self, values):
+        group_id = int(values.get('group_id'))
+        offset = int(values.get('offset', 0))
+        count = int(values.get('count', 1000))
+        items = [self._user(group_id * self.group_size + i)
+                 for i in range(offset, min(offset + count, self.group_size))]
+        return {'count': self.group_size, 'items': items}
+
+    def _get_subscriptions(self, name, values):
+        user_id = int(values.get('user_id'))
+        rng = random.Random(self.seed * 7_000_003 + user_id)
+        if rng.random() < self.private_ratio:
+            raise self._error(name, values, 30, 'This profile is private')
+        gids = rng.sample(self.group_ids, k=min(len(self.group_ids), rng.randint(1, 60)))
+        return {'count': len(gids),
+                'items': [{'id': g, 'name': f'group {g}', 'status': ''} for g in gids]}
+
+    def _dispatch(self, name, values):
+        if name == 'groups.getMembers':
+            return self._get_members(values)
+        if name == 'users.getSubscriptions':
+            return self._get_subscriptions(name, values)
+        if name == 'database.getCities':
+            q = str(values.get('q', '')).lower()
+            items = [{'id': i, 'title': c} for i, c in enumerate(FAKE_CITIES, start=1) if q and q in c.lower()]
+            return {'count': len(items), 'items': items}
+        raise self._error(name, values, 3, 'Unknown method passed')
+
+    def _execute(self, values):
+        """Разбирает код вида return [API.m({...}),...]; — так его формирует vk_utils.vk_execute."""
+        response, errors = [], []
+        for name, params in re.findall(r'API\.([\w.]+)\((\{.*?\})\)', values.get('code', '')):
+            try:
+                response.append(self._dispatch(name, json.loads(params)))
+            except vk_api.exceptions.ApiError as e:
+                response.append(False)
+                errors.append({'method': name, **e.error})
+        raw = {'response': response}
+        if errors:
+            raw['execute_errors'] = errors
+        return raw
+
+    def method(self, name, values=None, raw=False):
+        values = values or {}
+        with self.lock:
+            if self.fail_after is not None and self.calls >= self.fail_after:
+                raise QuotaExceeded('quota exceeded')
+            self._check_rate(name, values)
+            time.sleep(self.latency)
+        if name == 'execute':
+            result = self._execute(values)
+            return result if raw else result['response']
+        result = self._dispatch(name, values)
+        return {'response': result} if raw else result
@@ -0,0 +1,83 @@
+"""
+Локальная заглушка Yandex Search XML API.
+
+    with FakeYandexServer(latency=0.2) as server:
+        search_vk_groups(['запрос'], url=server.url, cache_dir=None)
+"""
+import hashlib
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+
+def fake_results(query, page, per_page=10):
+    """Детерминированные ссылки VK для (query, page): club/public и «короткие» адреса."""
+    seed = int(hashlib.sha1(query.encode('utf-8')).hexdigest()[:8], 16)
+    urls = []
+    for i in range(per_page):
+        n = (seed + page * per_page + i) % 100_000 + 1
+        kind = i % 5
+        if kind == 3:
+            urls.append(f"https://vk.com/public{n}")
+        elif kind == 4:
+            urls.append(f"https://vk.com/group_name_{n}")
+        else:
+            urls.append(f"https://vk.com/club{n}")
+    return urls
+
+
+def render_xml(urls):
+    docs = ''.join(f"<group><doc><url>{escape(u)}</url></doc></group>" for u in urls)
+    return f'<?xml version="1.0" encoding="utf-8"?><yandexsearch><response><results><grouping>{docs}</grouping></results></response></yandexsearch>'
+
+
+def render_error(code, message):
+    return (f'<?xml version="1.0" encoding="utf-8"?><yandexsearch><response>'
+            f'<error code="{code}">{escape(message)}</error></response></yandexsearch>')
+
+
+class FakeYandexServer:
+    """
+    HTTP-сервер в отдельном потоке; считает запросы и добавляет задержку.
+    error_code — отвечать ошибкой Яндекса (HTTP 200 с <error>), как при исчерпанной квоте.
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, error_code=None):
+        owner = self
+        self.latency = latency
+        self.error_code = error_code
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                owner.requests += 1
+                time.sleep(owner.latency)
+                params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                query = params.get('query', [''])[0]
+                page = int(params.get('page', ['0'])[0])
+                if owner.error_code is not None:
+                    body = render_error(owner.error_code, 'Request limit exceeded').encode('utf-8')
+                else:
+                    body = render_xml(fake_results(query, page)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.httpd.server_address[1]}/search/xml"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
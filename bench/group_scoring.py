@@ -0,0 +1,79 @@
+"""
+Проверка GroupScorer: рейтинг по очкам групп и нормам профилей должен
+совпадать с косинусным рейтингом по полным эмбеддингам пользователей
+(build_user_embeddings), при этом без (N, dim)-матрицы на запрос.
+Код возврата 1 — рейтинги разошлись.
+
+    python -m bench.group_scoring --users 20000 --top-k 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench.synthetic import load_universe, make_group_store, make_users
+
+
+def check(n_users=20_000, dim=768, top_k=50, n_prompts=5, workdir=None, seed=0):
+    from embeddings import GroupScorer, build_tfidf_matrix, build_user_embeddings, build_user_profiles, load_embeddings
+
+    groups_meta = load_universe()
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta)
+    emb_map = load_embeddings(make_group_store(groups_meta, os.path.join(workdir, 'groups'), dim=dim, seed=seed))
+    users = make_users(groups_meta, n_users, seed=seed)
+
+    user_ids, embs = build_user_embeddings(users, emb_map, groups_meta, vectorizer, tfidf_matrix)
+    p_ids, indptr, group_ids, norms = build_user_profiles(users, emb_map, groups_meta, vectorizer, tfidf_matrix)
+    assert np.array_equal(user_ids, p_ids), 'профили и эмбеддинги построены для разных пользователей'
+
+    rng = np.random.default_rng(seed + 1)
+    report = {'users': len(user_ids), 'memberships': len(group_ids), 'max_abs_diff': 0.0,
+              'explain_diff': 0.0, 'top_k_equal': True, 'cosine_s': 0.0, 'group_scores_s': 0.0}
+    for _ in range(n_prompts):
+        prompt = rng.standard_normal(dim).astype(np.float32)
+
+        start = time.perf_counter()
+        expected = embs @ prompt / np.maximum(np.linalg.norm(embs, axis=1) * np.linalg.norm(prompt), 1e-12)
+        report['cosine_s'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        scorer = GroupScorer(emb_map, prompt)
+        sims = scorer.score_users(indptr, group_ids, norms)
+        report['group_scores_s'] += time.perf_counter() - start
+
+        report['max_abs_diff'] = max(report['max_abs_diff'], float(np.abs(sims - expected).max()))
+        # порядок топа сравниваем с допуском на почти равные значения
+        top_expected = np.argsort(-expected, kind='stable')[:top_k]
+        top_actual = np.argsort(-sims, kind='stable')[:top_k]
+        same = np.array_equal(top_expected, top_actual) or np.allclose(
+            expected[top_expected], expected[top_actual], atol=1e-6)
+        report['top_k_equal'] &= bool(same)
+
+        # сумма вкладов групп (explain) равна similarity пользователя
+        i = int(top_actual[0])
+        contrib = scorer.explain(group_ids[indptr[i]:indptr[i + 1]], norms[i], top=None)
+        report['explain_diff'] = max(report['explain_diff'], abs(sum(c for _, c in contrib) - float(sims[i])))
+    report['ok'] = report['top_k_equal'] and report['max_abs_diff'] < 1e-4 and report['explain_diff'] < 1e-4
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--top-k', type=int, default=50)
+    parser.add_argument('--prompts', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = check(args.users, args.dim, args.top_k, args.prompts, workdir)
+    for key, value in report.items():
+        print(f"{key:<16} {value}")
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
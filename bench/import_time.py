@@ -0,0 +1,61 @@
+"""
+Проверка времени старта: импорт модулей, которые загружает main.py, в чистом
+интерпретаторе должен укладываться в бюджет и не тянуть тяжёлые библиотеки
+(torch, sentence_transformers, sklearn, langchain, pymorphy3, vk_api).
+Код возврата 1 — бюджет превышен или что-то загрузилось раньше времени.
+
+    python -m bench.import_time --budget 1.0
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from bench.synthetic import REPO_DIR
+
+MODULES = ['tracing', 'sberchat', 'yandex_search', 'pipeline']
+HEAVY = ['torch', 'sentence_transformers', 'sklearn', 'langchain', 'langchain_gigachat', 'pymorphy3', 'vk_api']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'loaded': loaded}}))
+'''
+
+
+def measure_imports(modules=MODULES, heavy=HEAVY, repeat=3):
+    """Лучшее из repeat холодных запусков: {'seconds', 'loaded'}."""
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(modules=modules, heavy=heavy)],
+                             cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=1.0, help='секунд на импорт модулей main.py')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    result = measure_imports(repeat=args.repeat)
+    print(f"импорт {', '.join(MODULES)}: {result['seconds']:.3f} с (бюджет {args.budget} с)")
+    ok = True
+    if result['loaded']:
+        print('загружены раньше времени:', ', '.join(result['loaded']))
+        ok = False
+    if result['seconds'] > args.budget:
+        print('бюджет превышен')
+        ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Проверка квантованного UserIndex: top-k по int8-кодам с точным float32-пересчётом
+кандидатов против точного top-k по float32. Отчёт — recall@k, доля запросов
+с неизменным top-k, память на пользователя, время построения и поиска. Индекс
+строится потоково (user_index.write_index, блоками по --chunk пользователей)
+и открывается через memmap, как в рабочем режиме (/rank сервера).
+Код возврата 1 — recall ниже --min-recall.
+
+    python -m bench.quantized_index --users 50000 --top-k 5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench.synthetic import load_universe, make_group_store, make_users
+
+
+def check(n_users=50_000, dim=768, top_k=5, n_prompts=50, n_candidates=None, workdir=None, seed=0,
+          chunk=10_000):
+    from embeddings import build_tfidf_matrix, build_user_embeddings, load_embeddings
+    from user_index import UserIndex, write_index
+
+    groups_meta = load_universe()
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta)
+    emb_map = load_embeddings(make_group_store(groups_meta, os.path.join(workdir, 'groups'), dim=dim, seed=seed))
+    users = make_users(groups_meta, n_users, seed=seed)
+    user_ids, embs = build_user_embeddings(users, emb_map, groups_meta, vectorizer, tfidf_matrix)
+
+    exact = UserIndex(user_ids, embs)
+    start = time.perf_counter()
+    blocks = ((user_ids[i:i + chunk], embs[i:i + chunk]) for i in range(0, len(user_ids), chunk))
+    quantized = write_index(os.path.join(workdir, 'index'), blocks, capacity=n_users)
+    build_s = time.perf_counter() - start
+
+    # промпты: половина — случайные векторы, половина — рядом с эмбеддингом одной из групп
+    rng = np.random.default_rng(seed + 1)
+    prompts = rng.standard_normal((n_prompts, dim)).astype(np.float32)
+    themed = embs[rng.integers(0, len(embs), size=n_prompts // 2)]
+    prompts[:len(themed)] = themed / np.linalg.norm(themed, axis=1, keepdims=True) + 0.05 * prompts[:len(themed)]
+
+    report = {'users': len(user_ids), 'top_k': top_k,
+              'float32_bytes_per_user': dim * 4,
+              'int8_bytes_per_user': quantized.codes.itemsize * dim + quantized.scales.itemsize,
+              'build_s': build_s, 'recall': 0.0, 'top_k_unchanged': 0.0, 'exact_s': 0.0, 'quantized_s': 0.0}
+    for prompt in prompts:
+        start = time.perf_counter()
+        expected, expected_scores = exact.search(prompt, top_k=top_k)
+        report['exact_s'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual, actual_scores = quantized.search(prompt, top_k=top_k, n_candidates=n_candidates)
+        report['quantized_s'] += time.perf_counter() - start
+
+        # у пользователей с одинаковыми подписками эмбеддинги совпадают — такие
+        # «ничьи» считаем верными, если совпадают сами значения similarity
+        hits = len(np.intersect1d(expected, actual))
+        same = np.array_equal(expected, actual) or np.allclose(expected_scores, actual_scores, atol=1e-6)
+        report['recall'] += (len(expected) if same else hits) / len(expected) / n_prompts
+        report['top_k_unchanged'] += same / n_prompts
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--prompts', type=int, default=50)
+    parser.add_argument('--candidates', type=int, default=None, help='кандидатов на float32-пересчёт')
+    parser.add_argument('--chunk', type=int, default=10_000, help='пользователей на блок при построении')
+    parser.add_argument('--min-recall', type=float, default=0.99)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        report = check(args.users, args.dim, args.top_k, args.prompts, args.candidates, workdir,
+                       chunk=args.chunk)
+    for key, value in report.items():
+        print(f"{key:<24} {round(value, 4) if isinstance(value, float) else value}")
+    sys.exit(0 if report['recall'] >= args.min_recall else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Бенчмарк стадий пайплайна на синтетических данных и заглушках VK/Яндекса.
+Стадии — те же функции, что работают в /search (run_pipeline): разбор
+запроса, фильтр участников, профили и GroupScorer, потоковый сборщик, поиск
+групп. Для каждой стадии — пропускная способность, p50/p99 латентности и
+peak_rss_mb_so_far: ru_maxrss процесса на момент конца стадии, то есть
+максимум за все стадии до неё включительно, а не память самой стадии.
+Результат пишется в JSON для сравнения ревизий. Квантованный индекс
+пользователей (/rank) проверяет отдельный bench.quantized_index.
+
+    python -m bench.run --users 10000 --out bench_result.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench.fake_vk import FakeVkSession
+from bench.fake_yandex import FakeYandexServer
+from bench.synthetic import GROUPS_CSV, load_universe, make_group_store, make_users
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = ['пенсионерки Екатеринбург', 'студенты питер', 'мужчины 30-40 лет москва',
+           'девушки казань', 'москвичи', 'школьники', 'жители нижнего новгорода']
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(fn, repeat=1, items=1):
+    """Запускает fn repeat раз; items — сколько единиц работы в одном вызове."""
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    lat = np.array(latencies)
+    return {
+        'calls': repeat,
+        'items_per_call': items,
+        'total_s': round(float(lat.sum()), 6),
+        'throughput_per_s': round(items * repeat / float(lat.sum()), 2) if lat.sum() else None,
+        'p50_ms': round(float(np.percentile(lat, 50)) * 1000, 3),
+        'p99_ms': round(float(np.percentile(lat, 99)) * 1000, 3),
+        'peak_rss_mb_so_far': peak_rss_mb(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def raw_members(users):
+    """Пользователи в виде сырых словарей groups.getMembers (вход filter_members)."""
+    from filtering import SEX_LABELS
+    codes = {label: code for code, label in SEX_LABELS.items()}
+    return [{'id': int(uid), 'bdate': bdate, 'sex': codes[sex], 'city': {'title': city}}
+            for uid, bdate, sex, city in zip(users['user_id'], users['bdate'], users['sex'], users['city'])]
+
+
+def run(n_users, dim, vk_latency, yandex_latency, collect_target, workdir):
+    import vk_utils
+    from contextlib import redirect_stdout
+    from embeddings import GroupScorer, build_tfidf_matrix, build_user_profiles, load_embeddings
+    from tfidf_store import load_tfidf
+    from filtering import filter_members, get_city_index, parse_city, prepare_audience, query_mask, parse_query_filters
+    from pipeline import collect_users
+    from yandex_search import search_vk_groups
+
+    quiet = open(os.devnull, 'w')
+    stages = {}
+    groups_meta = load_universe()
+    stages['build_tfidf'] = measure(lambda: build_tfidf_matrix(groups_meta), items=len(groups_meta))
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta)
+    # кэш артефактов TF-IDF: первый вызов строит его, дальше — открытие через memmap
+    tfidf_cache = os.path.join(workdir, 'tfidf_cache')
+    load_tfidf(GROUPS_CSV, tfidf_cache)
+    stages['load_tfidf_cached'] = measure(lambda: load_tfidf(GROUPS_CSV, tfidf_cache), repeat=5)
+    emb_map = load_embeddings(make_group_store(groups_meta, os.path.join(workdir, 'groups'), dim=dim))
+    users = make_users(groups_meta, n_users)
+    members = raw_members(users)
+    prepare_audience(users)
+
+    # разбор запроса и фильтры: по готовой аудитории и по страницам getMembers
+    cities = users['city'].cat.categories.tolist()
+    city_index = get_city_index(cities, path=None)
+    it = iter(QUERIES * 50)
+    stages['parse_city'] = measure(lambda: parse_city(next(it), city_index), repeat=len(QUERIES) * 50)
+    with redirect_stdout(quiet):
+        filters = [parse_query_filters(q, cities) for q in QUERIES]
+    it = iter(filters * 3)
+    stages['query_mask'] = measure(
+        lambda: query_mask('', users, next(it)), repeat=len(filters) * 3, items=n_users)
+    pages = [members[i:i + 1000] for i in range(0, len(members), 1000)]
+    it = iter([(page, f) for f in filters for page in pages])
+    stages['filter_members'] = measure(lambda: filter_members(*next(it)), repeat=len(filters) * len(pages),
+                                       items=len(pages[0]))
+
+    # профили пользователей и рейтинг GroupScorer (эмбеддинг промпта — случайный
+    # вектор, чтобы не зависеть от загрузки SentenceTransformer)
+    result = {}
+    stages['user_profiles'] = measure(
+        lambda: result.update(out=build_user_profiles(users, emb_map, groups_meta, vectorizer, tfidf_matrix)),
+        items=n_users)
+    _, indptr, group_ids, norms = result['out']
+    prompts = iter(np.random.default_rng(0).standard_normal((50, dim)).astype(np.float32))
+    stages['score_users'] = measure(
+        lambda: GroupScorer(emb_map, next(prompts)).score_users(indptr, group_ids, norms),
+        repeat=50, items=len(norms))
+
+    # потоковый сборщик (stream_users) на заглушке VK
+    api = vk_utils.VkApiPool([FakeVkSession(latency=vk_latency, rate_limit=3, seed=0,
+                                            group_ids=groups_meta['group_id'])], rate=3)
+    with redirect_stdout(quiet):
+        stages['collector'] = measure(
+            lambda: collect_users([1, 2, 3], collect_target, api=api),
+            items=collect_target)
+
+    # поиск групп на заглушке Яндекса
+    with FakeYandexServer(latency=yandex_latency) as server:
+        stages['yandex_search'] = measure(
+            lambda: search_vk_groups(QUERIES[:3], pages=3, url=server.url, cache_dir=None), items=9)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000, help='число синтетических пользователей (1k–1M)')
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--vk-latency', type=float, default=0.1)
+    parser.add_argument('--yandex-latency', type=float, default=0.2)
+    parser.add_argument('--collect-target', type=int, default=100)
+    parser.add_argument('--out', default=None, help='файл для JSON-отчёта (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        stages = run(args.users, args.dim, args.vk_latency, args.yandex_latency, args.collect_target, workdir)
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
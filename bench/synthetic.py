@@ -0,0 +1,67 @@
+"""Синтетические пользователи, подписки и эмбеддинги групп поверх data/groups_clean.csv."""
+import os
+
+import numpy as np
+import pandas as pd
+
+from embeddings import load_group_metadata
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUPS_CSV = os.path.join(REPO_DIR, 'data', 'groups_clean.csv')
+CITIES = ['Москва', 'Санкт-Петербург', 'Екатеринбург', 'Казань', 'Нижний Новгород',
+          'Новосибирск', 'Самара', 'Краснодар', 'Пермь', 'Уфа']
+
+
+def load_universe(csv_path=GROUPS_CSV):
+    return load_group_metadata(csv_path)
+
+
+def make_group_store(groups_meta, prefix, dim=768, known_ratio=0.6, seed=0):
+    """
+    Эмбеддинги для доли known_ratio групп каталога в формате GroupEmbeddingStore
+    (остальные группы резолвятся через TF-IDF, как в реальных данных).
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.sort(groups_meta['group_id'].to_numpy(dtype=np.int64))
+    ids = np.sort(rng.choice(ids, size=int(len(ids) * known_ratio), replace=False))
+    matrix = np.lib.format.open_memmap(prefix + '.emb.npy', mode='w+', dtype=np.float32, shape=(len(ids), dim))
+    for start in range(0, len(ids), 4096):
+        block = rng.standard_normal((min(4096, len(ids) - start), dim)).astype(np.float32)
+        matrix[start:start + len(block)] = block
+    matrix.flush()
+    np.save(prefix + '.ids.npy', ids)
+    return prefix
+
+
+def make_users(groups_meta, n_users, max_groups=30, unknown_ratio=0.1, seed=0):
+    """
+    DataFrame пользователей в формате хранилища: user_id, bdate, sex (строкой),
+    city, groups — список {id, name, status}. Часть подписок — группы вне
+    каталога (unknown_ratio) с текстом существующей группы.
+    """
+    rng = np.random.default_rng(seed)
+    gids = groups_meta['group_id'].to_numpy(dtype=np.int64)
+    names = groups_meta['name'].fillna('').to_numpy()
+    statuses = groups_meta['status'].fillna('').to_numpy()
+    n_groups = rng.integers(1, max_groups + 1, size=n_users)
+    picks = rng.integers(0, len(gids), size=int(n_groups.sum()))
+    unknown = rng.random(len(picks)) < unknown_ratio
+    groups, pos = [], 0
+    for k in n_groups:
+        groups.append([
+            {'id': int(gids[j]) + (10 ** 10 if unk else 0), 'name': names[j], 'status': statuses[j]}
+            for j, unk in zip(picks[pos:pos + k], unknown[pos:pos + k])
+        ])
+        pos += k
+    years = rng.integers(1945, 2012, size=n_users)
+    bdate = [f"{d}.{m}.{y}" if has_year else f"{d}.{m}"
+             for d, m, y, has_year in zip(rng.integers(1, 29, n_users), rng.integers(1, 13, n_users),
+                                          years, rng.random(n_users) < 0.7)]
+    return pd.DataFrame({
+        'user_id': np.arange(1, n_users + 1, dtype=np.int64),
+        'bdate': bdate,
+        'sex': rng.choice(['Женский', 'Мужской'], size=n_users),
+        'city': rng.choice(CITIES, size=n_users),
+        'country': 'Россия',
+        'groups': groups,
+    })
@@ -1,11 +1,14 @@
+import os
 import pickle
 import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import ast
 import json
-from sentence_transformers import SentenceTransformer
+import threading
+from collections import OrderedDict
+from fs_utils import atomic_write
+from user_index import UserIndex
+from tracing import span, count, traced
 
 
 
@@ -17,34 +20,208 @@ def load_group_metadata(csv_path):
 
 def build_tfidf_matrix(groups_meta, min_df=2):
     """Построение TF-IDF матрицы по текстам групп."""
-    vectorizer = TfidfVectorizer(min_df=min_df)
-    tfidf_matrix = vectorizer.fit_transform(groups_meta['text'])
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    with span('embeddings.build_tfidf', groups=len(groups_meta)):
+        vectorizer = TfidfVectorizer(min_df=min_df)
+        tfidf_matrix = vectorizer.fit_transform(groups_meta['text'])
     return vectorizer, tfidf_matrix
 
-def load_embeddings(pkl_path):
-    """Загрузка эмбеддингов групп из pickle."""
+class GroupEmbeddingStore:
+    """
+    Хранилище эмбеддингов групп: одна непрерывная float32-матрица (memmap)
+    и отсортированный int64-индекс group_id. Поддерживает интерфейс словаря
+    (in, [], get), поэтому подходит везде, где раньше был emb_map из pickle.
+    """
+
+    def __init__(self, prefix):
+        self.ids = np.load(prefix + '.ids.npy')
+        self.matrix = np.load(prefix + '.emb.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, gids):
+        """Индексы строк для массива gid; -1 — группы нет в хранилище."""
+        gids = np.asarray(gids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, gids)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        return np.where(self.ids[pos] == gids, pos, -1) if len(self.ids) else np.full(len(gids), -1)
+
+    def __contains__(self, gid):
+        return gid is not None and self.rows([gid])[0] >= 0
+
+    def get(self, gid, default=None):
+        if gid is None:
+            return default
+        row = self.rows([gid])[0]
+        # строка memmap — это view без копирования
+        return self.matrix[row] if row >= 0 else default
+
+    def __getitem__(self, gid):
+        emb = self.get(gid)
+        if emb is None:
+            raise KeyError(gid)
+        return emb
+
+def convert_embeddings(pkl_path, prefix):
+    """
+    Однократная конвертация pickle-словаря {group_id: np.ndarray} в формат
+    GroupEmbeddingStore: prefix.emb.npy (float32, N×dim) и prefix.ids.npy (int64).
+    """
     with open(pkl_path, 'rb') as f:
         emb_map = pickle.load(f)
-    return emb_map
-
-def get_group_emb(g, emb_map, groups_meta, vectorizer, tfidf_matrix, sim_threshold=0.45):
-    """
-    Получение эмбеддинга группы:
-    1. Если есть в emb_map — возвращаем.
-    2. Иначе ищем ближайшую по TF-IDF.
-    """
-    gid = g['id']
-    if gid in emb_map:
-        return emb_map[gid]
-    txt = ((g.get('name') or '') + ' ' + (g.get('status') or '')).strip()
-    q_vec = vectorizer.transform([txt])
-    sims = cosine_similarity(q_vec, tfidf_matrix)[0]
-    best_idx = sims.argmax()
-    max_sim = sims[best_idx]
-    if max_sim < sim_threshold:
-        return None
-    best_gid = groups_meta.iloc[best_idx]['group_id']
-    return emb_map.get(best_gid)
+    items = [(int(gid), emb) for gid, emb in emb_map.items() if isinstance(emb, np.ndarray)]
+    items.sort(key=lambda kv: kv[0])
+    ids = np.fromiter((gid for gid, _ in items), dtype=np.int64, count=len(items))
+    matrix = np.lib.format.open_memmap(
+        prefix + '.emb.npy', mode='w+', dtype=np.float32,
+        shape=(len(items), len(items[0][1]) if items else 0)
+    )
+    for i, (_, emb) in enumerate(items):
+        matrix[i] = emb
+    matrix.flush()
+    np.save(prefix + '.ids.npy', ids)
+
+@traced('embeddings.load_embeddings')
+def load_embeddings(path):
+    """
+    Загрузка эмбеддингов групп. Для .pkl — словарь из pickle (как раньше),
+    иначе path — префикс файлов GroupEmbeddingStore. Если хранилища ещё нет,
+    а рядом лежит path + '.pkl', выполняется однократная конвертация.
+    """
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            emb_map = pickle.load(f)
+        return emb_map
+    if not os.path.exists(path + '.ids.npy') and os.path.exists(path + '.pkl'):
+        convert_embeddings(path + '.pkl', path)
+    return GroupEmbeddingStore(path)
+
+def take_group_embs(emb_map, gids):
+    """
+    Выборка эмбеддингов для списка gid (None допустим).
+    Возвращает (found, matrix): булеву маску найденных и float32-матрицу
+    только для найденных, в исходном порядке.
+    """
+    if isinstance(emb_map, GroupEmbeddingStore):
+        rows = emb_map.rows([-1 if g is None else g for g in gids])
+        found = rows >= 0
+        return found, np.asarray(emb_map.matrix[rows[found]], dtype=np.float32)
+    embs = [emb_map.get(g) for g in gids]
+    found = np.array([isinstance(e, np.ndarray) for e in embs], dtype=bool)
+    valid = [e for e in embs if isinstance(e, np.ndarray)]
+    if not valid:
+        return found, np.empty((0, 0), dtype=np.float32)
+    return found, np.vstack(valid).astype(np.float32, copy=False)
+
+def load_nearest_cache(cache_path, sim_threshold, n_groups):
+    """
+    Загрузка кэша gid → ближайший gid по TF-IDF.
+    Кэш сбрасывается, если изменились порог или размер каталога групп.
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if data.get('sim_threshold') != sim_threshold or data.get('n_groups') != n_groups:
+        return {}
+    return {int(k): v for k, v in data.get('nearest', {}).items()}
+
+def save_nearest_cache(cache_path, nearest, sim_threshold, n_groups):
+    """Сохранение кэша gid → ближайший gid (None — похожей группы нет)."""
+    data = {
+        'sim_threshold': sim_threshold,
+        'n_groups': n_groups,
+        'nearest': {str(k): v for k, v in nearest.items()},
+    }
+    # запись через временный файл: параллельные запросы не читают недописанный JSON
+    with atomic_write(cache_path) as f:
+        json.dump(data, f, ensure_ascii=False)
+
+_nearest_caches = {}  # cache_path → {'params', 'nearest', 'dirty'}: общий для всех запросов процесса
+_nearest_lock = threading.Lock()
+
+def _nearest_cache(cache_path, sim_threshold, n_groups):
+    """
+    Кэш gid → ближайший gid в памяти; с диска читается при первом обращении
+    (и заново, если изменились порог или размер каталога). Вызывать под _nearest_lock.
+    """
+    cache = _nearest_caches.get(cache_path)
+    if cache is None or cache['params'] != (sim_threshold, n_groups):
+        cache = {'params': (sim_threshold, n_groups),
+                 'nearest': load_nearest_cache(cache_path, sim_threshold, n_groups), 'dirty': False}
+        _nearest_caches[cache_path] = cache
+    return cache
+
+def flush_nearest_cache(cache_path):
+    """
+    Записывает новые записи кэша cache_path на диск (одна запись за запуск
+    вместо перезаписи файла на каждый пакет). Записи, появившиеся в файле
+    от другого процесса, сохраняются.
+    """
+    with _nearest_lock:
+        cache = _nearest_caches.get(cache_path)
+        if cache is None or not cache['dirty']:
+            return
+        sim_threshold, n_groups = cache['params']
+        nearest = load_nearest_cache(cache_path, sim_threshold, n_groups)
+        nearest.update(cache['nearest'])
+        save_nearest_cache(cache_path, nearest, sim_threshold, n_groups)
+        cache['nearest'] = nearest
+        cache['dirty'] = False
+
+def resolve_unknown_groups(groups, emb_map, groups_meta, vectorizer, tfidf_matrix,
+                           sim_threshold=0.45, cache_path=None):
+    """
+    Пакетный поиск ближайшей группы по TF-IDF для групп, которых нет в emb_map.
+    Все тексты векторизуются одним вызовом transform, сходство считается одним
+    разреженным произведением. Возвращает dict gid → ближайший gid или None.
+    Если задан cache_path, результаты переиспользуются между пакетами и
+    запросами (в памяти) и между запусками — после flush_nearest_cache.
+    """
+    n_groups = tfidf_matrix.shape[0]
+    # наличие в emb_map — одним searchsorted по всему пакету, а не поиском на каждую группу
+    gids = list(dict.fromkeys(g.get('id') for g in groups if g.get('id') is not None))
+    if isinstance(emb_map, GroupEmbeddingStore):
+        stored = set(np.asarray(gids, dtype=np.int64)[emb_map.rows(gids) >= 0].tolist())
+    else:
+        stored = {gid for gid in gids if gid in emb_map}
+    if cache_path:
+        with _nearest_lock:
+            nearest = _nearest_cache(cache_path, sim_threshold, n_groups)['nearest']
+            known = {g.get('id'): nearest[g.get('id')] for g in groups if g.get('id') in nearest}
+    else:
+        known = {}
+
+    todo = {}
+    for g in groups:
+        gid = g.get('id')
+        if gid is None or gid in stored or gid in known or gid in todo:
+            continue
+        todo[gid] = ((g.get('name') or '') + ' ' + (g.get('status') or '')).strip()
+
+    if todo:
+        count('embeddings.tfidf_fallback', len(todo))
+        with span('embeddings.tfidf_fallback', groups=len(todo)):
+            q_mat = vectorizer.transform(list(todo.values()))
+            # строки уже L2-нормированы TfidfVectorizer — косинус без копии матрицы
+            sims = (q_mat @ tfidf_matrix.T).tocsr()
+        best_idx = np.asarray(sims.argmax(axis=1)).ravel()
+        max_sim = sims.max(axis=1).toarray().ravel()
+        group_ids = groups_meta['group_id'].to_numpy()
+        found = {gid: int(group_ids[idx]) if sim >= sim_threshold else None
+                 for gid, idx, sim in zip(todo, best_idx, max_sim)}
+        known.update(found)
+        if cache_path:
+            with _nearest_lock:
+                cache = _nearest_cache(cache_path, sim_threshold, n_groups)
+                cache['nearest'].update(found)
+                cache['dirty'] = True
+
+    return {g.get('id'): known.get(g.get('id')) for g in groups
+            if g.get('id') is not None and g.get('id') not in stored}
 
 def parse_groups(groups_data):
 
@@ -68,52 +245,230 @@ def parse_groups(groups_data):
     
     return parsed_groups
 
-def get_prompt_embedding(text: str) -> np.ndarray:
+def _user_memberships(users, emb_map, groups_meta, vectorizer, tfidf_matrix, sim_threshold, cache_path):
     """
-    Кодируем строку в вектор той же размерности, что и user_embedding.
+    Общая часть build_user_embeddings и build_user_profiles: группы
+    пользователей, резолвнутые в группы из emb_map (неизвестные — через
+    TF-IDF). Возвращает (user_ids, membership, col_gids, group_matrix):
+    membership — CSR user×столбец с весами 1/число_групп, col_gids — gid
+    группы из emb_map для каждого столбца, group_matrix — их эмбеддинги.
+    membership is None, если ни одна группа не нашлась.
     """
-    model = SentenceTransformer(
-        "sentence-transformers/all-mpnet-base-v2",
-        cache_folder="./local_models",
-        local_files_only=True
+    # 1) уникальные группы в порядке первого появления
+    user_groups = []
+    distinct = {}
+    for gs in users['groups']:
+        gids = []
+        for g in parse_groups(gs):
+            gid = g.get('id')
+            if gid is None:
+                continue
+            distinct.setdefault(gid, g)
+            gids.append(gid)
+        user_groups.append(gids)
+
+    nearest = resolve_unknown_groups(list(distinct.values()), emb_map, groups_meta, vectorizer,
+                                     tfidf_matrix, sim_threshold, cache_path)
+    target = [nearest[gid] if gid in nearest else gid for gid in distinct]
+    found, group_matrix = take_group_embs(emb_map, target)
+    col_of = {gid: col for col, gid in enumerate(gid for gid, ok in zip(distinct, found) if ok)}
+    col_gids = np.array([t for t, ok in zip(target, found) if ok], dtype=np.int64)
+
+    user_ids_all = users['user_id'].to_numpy()
+    if not col_of:
+        return user_ids_all, None, col_gids, group_matrix
+
+    # 2) разреженная матрица членства (повторы группы суммируются, как в np.mean по списку)
+    indptr = [0]
+    indices = []
+    for gids in user_groups:
+        indices.extend(col_of[gid] for gid in gids if gid in col_of)
+        indptr.append(len(indices))
+    indptr = np.asarray(indptr, dtype=np.int64)
+    counts = np.diff(indptr)
+    data = np.repeat(1.0 / np.maximum(counts, 1), counts).astype(np.float32)
+    import scipy.sparse as sp
+
+    membership = sp.csr_matrix(
+        (data, np.asarray(indices, dtype=np.int64), indptr),
+        shape=(len(user_groups), group_matrix.shape[0]),
     )
-    # convert_to_numpy=True вернёт np.ndarray
-    emb = model.encode([text], convert_to_numpy=True)[0]
-    return emb  # shape = (dim,)
+    return user_ids_all, membership, col_gids, group_matrix
 
-def recommend_users(
-    filtered_df: pd.DataFrame,
-    prompt: str,
-    top_k: int = 10
-) -> pd.DataFrame:
+@traced('embeddings.build_user_embeddings')
+def build_user_embeddings(users, emb_map, groups_meta, vectorizer, tfidf_matrix,
+                          sim_threshold=0.45, cache_path=None):
     """
-    Для каждого user_embedding из filtered_df считает cosine-similarity
-    с embedding промпта и возвращает топ-K пользователей.
+    Пакетный расчёт эмбеддингов пользователей.
+    1. Собираем все уникальные группы всех пользователей и резолвим каждую один раз
+       (неизвестные — пакетно через resolve_unknown_groups).
+    2. Строим разреженную матрицу членства user×group с весами 1/len(groups).
+    3. Одно умножение на матрицу эмбеддингов групп даёт среднее по группам.
+    Возвращает (user_ids, emb_matrix): int64-массив id и float32-матрицу (N, dim)
+    только для пользователей, у которых нашлась хотя бы одна группа.
     """
-    # 3.1) Генерируем embedding промпта
-    prompt_emb = get_prompt_embedding(prompt)
+    user_ids_all, membership, _, group_matrix = _user_memberships(
+        users, emb_map, groups_meta, vectorizer, tfidf_matrix, sim_threshold, cache_path)
+    if membership is None:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
 
-    # 3.2) Оставляем только валидные эмбеддинги нужной размерности
-    mask = filtered_df['user_embedding'].apply(
-        lambda x: isinstance(x, (list, np.ndarray))
-                  and len(x) == prompt_emb.shape[0]
-    )
-    df_valid = filtered_df.loc[mask].copy()
-    if df_valid.empty:
-        raise ValueError("Нет валидных user_embedding для сравнения.")
+    # 3) одно умножение — среднее по валидным группам
+    keep = np.diff(membership.indptr) > 0
+    emb_matrix = np.asarray(membership[keep] @ group_matrix, dtype=np.float32)
+    return user_ids_all[keep].astype(np.int64), emb_matrix
+
+PROFILE_CHUNK = 4096  # пользователей на один блок при расчёте норм
+
+@traced('embeddings.build_user_profiles')
+def build_user_profiles(users, emb_map, groups_meta, vectorizer, tfidf_matrix,
+                        sim_threshold=0.45, cache_path=None):
+    """
+    Профили пользователей для GroupScorer — вместо (N, dim)-матрицы эмбеддингов.
+    Эмбеддинг пользователя — среднее эмбеддингов его групп, поэтому для
+    сходства с промптом достаточно списка групп (уже резолвнутых в emb_map)
+    и нормы эмбеддинга; норма считается здесь один раз (блоками) и может
+    храниться вместе с пользователем (user_store.save_profiles).
+    Возвращает (user_ids, indptr, group_ids, norms): группы i-го пользователя —
+    group_ids[indptr[i]:indptr[i + 1]] (с повторами); только пользователи,
+    у которых нашлась хотя бы одна группа.
+    """
+    user_ids_all, membership, col_gids, group_matrix = _user_memberships(
+        users, emb_map, groups_meta, vectorizer, tfidf_matrix, sim_threshold, cache_path)
+    if membership is None:
+        return (np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+    keep = np.diff(membership.indptr) > 0
+    membership = membership[keep]
+    norms = np.empty(membership.shape[0], dtype=np.float32)
+    for start in range(0, membership.shape[0], PROFILE_CHUNK):
+        block = np.asarray(membership[start:start + PROFILE_CHUNK] @ group_matrix)
+        norms[start:start + len(block)] = np.linalg.norm(block, axis=1)
+    return (user_ids_all[keep].astype(np.int64), membership.indptr.astype(np.int64),
+            col_gids[membership.indices], norms)
+
+class GroupScorer:
+    """
+    Сходство промпта с пользователями через их группы. Эмбеддинг пользователя —
+    среднее эмбеддингов групп, поэтому cos(u, p) = mean_i(g_i · p̂) / |u|:
+    промпт один раз умножается на всю таблицу эмбеддингов групп (одно
+    произведение матрица × вектор), а рейтинг пользователей собирается из
+    очков их групп за O(общего числа подписок) — без (N, dim)-матрицы.
+    Нормы |u| берутся из профилей (build_user_profiles).
+    """
+
+    def __init__(self, emb_map, prompt_emb):
+        prompt = np.asarray(prompt_emb, dtype=np.float32)
+        prompt = prompt / max(float(np.linalg.norm(prompt)), 1e-12)
+        if isinstance(emb_map, GroupEmbeddingStore):
+            self.ids, matrix = emb_map.ids, emb_map.matrix
+        else:
+            gids = sorted(g for g, e in emb_map.items() if isinstance(e, np.ndarray))
+            self.ids = np.array(gids, dtype=np.int64)
+            matrix = (np.vstack([emb_map[g] for g in gids]).astype(np.float32, copy=False)
+                      if gids else np.empty((0, len(prompt)), dtype=np.float32))
+        with span('embeddings.score_groups', groups=len(self.ids)):
+            self.scores = np.asarray(matrix @ prompt, dtype=np.float32)
 
-    # 3.3) Матрица эмбеддингов shape=(N, dim)
-    emb_matrix = np.vstack(df_valid['user_embedding'].values).astype(np.float32)
+    def group_scores(self, group_ids):
+        """g · p̂ для массива gid; группам не из таблицы — 0."""
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.zeros(len(group_ids), dtype=np.float32)
+        pos = np.minimum(np.searchsorted(self.ids, group_ids), len(self.ids) - 1)
+        found = self.ids[pos] == group_ids
+        count('embeddings.unscored_groups', int((~found).sum()))
+        return np.where(found, self.scores[pos], 0.0).astype(np.float32)
 
-    # 3.4) Считаем cosine-similarity
-    sims = cosine_similarity(
-        prompt_emb.reshape(1, -1),
-        emb_matrix,
-    )[0]
+    def score_users(self, indptr, group_ids, norms):
+        """Косинусное сходство промпта с пользователями профилей (indptr, group_ids, norms)."""
+        counts = np.diff(indptr)
+        owner = np.repeat(np.arange(len(counts)), counts)
+        sums = np.bincount(owner, weights=self.group_scores(group_ids), minlength=len(counts))
+        return (sums / np.maximum(counts, 1) / np.maximum(norms, 1e-12)).astype(np.float32)
 
-    # 3.5) Добавляем колонку и сортируем
-    df_valid['similarity'] = sims
-    df_sorted = df_valid.sort_values('similarity', ascending=False)
+    def explain(self, group_ids, norm, top=3):
+        """
+        Почему пользователь высоко в рейтинге: группы с наибольшим вкладом
+        [(gid, вклад)]; сумма вкладов всех его групп (top=None) равна similarity.
+        """
+        gids, reps = np.unique(np.asarray(group_ids, dtype=np.int64), return_counts=True)
+        contrib = self.group_scores(gids) * reps / (max(len(group_ids), 1) * max(float(norm), 1e-12))
+        order = np.argsort(-contrib)[:top]
+        return [(int(gids[i]), float(contrib[i])) for i in order]
 
-    # 3.6) Берём топ-K
-    return df_sorted.head(top_k)
+_model = None
+_model_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_prompt_cache = OrderedDict()
+PROMPT_CACHE_SIZE = 1024
+
+def get_model():
+    """SentenceTransformer создаётся один раз на процесс, при первом обращении."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                # torch и sentence_transformers грузятся секунды — только при первом обращении
+                from sentence_transformers import SentenceTransformer
+
+                with span('embeddings.load_model'):
+                    _model = SentenceTransformer(
+                        "sentence-transformers/all-mpnet-base-v2",
+                        cache_folder="./local_models",
+                        local_files_only=True
+                    )
+    return _model
+
+def _normalize_prompt(text: str) -> str:
+    return ' '.join(text.split())
+
+def get_prompt_embeddings(texts: list[str]) -> np.ndarray:
+    """
+    Кодируем список строк одним вызовом encode. Уже посчитанные промпты
+    берутся из LRU-кэша (ключ — промпт с нормализованными пробелами).
+    Возвращает матрицу shape = (len(texts), dim).
+    """
+    keys = [_normalize_prompt(t) for t in texts]
+    found = {}
+    with _cache_lock:
+        for k in keys:
+            if k in _prompt_cache:
+                _prompt_cache.move_to_end(k)
+                found[k] = _prompt_cache[k]
+    missing = [k for k in dict.fromkeys(keys) if k not in found]
+    count('embeddings.prompt_cache_hit', len(keys) - len(missing))
+    if missing:
+        # convert_to_numpy=True вернёт np.ndarray
+        embs = get_model().encode(missing, convert_to_numpy=True)
+        with _cache_lock:
+            for k, emb in zip(missing, embs):
+                emb.setflags(write=False)
+                _prompt_cache[k] = emb
+                found[k] = emb
+            while len(_prompt_cache) > PROMPT_CACHE_SIZE:
+                _prompt_cache.popitem(last=False)
+    return np.vstack([found[k] for k in keys])
+
+def get_prompt_embedding(text: str) -> np.ndarray:
+    """
+    Кодируем строку в вектор той же размерности, что и user_embedding.
+    """
+    return get_prompt_embeddings([text])[0]  # shape = (dim,)
+
+def recommend_from_index(
+    index: UserIndex,
+    prompt: str,
+    top_k: int = 10,
+    mask: np.ndarray | None = None,
+    n_probe: int | None = None
+) -> pd.DataFrame:
+    """
+    Топ-K пользователей из UserIndex по сходству с промптом: DataFrame
+    (user_id, similarity). mask — пред-фильтр строк индекса (например, по
+    фильтрам запроса), n_probe — приближённый IVF-поиск.
+    """
+    prompt_emb = get_prompt_embedding(prompt)
+    if len(index) == 0 or index.matrix.shape[1] != prompt_emb.shape[0]:
+        raise ValueError("Индекс пользователей пуст или построен для другой модели эмбеддингов.")
+    rows, sims = index.search(prompt_emb, top_k=top_k, mask=mask, n_probe=n_probe)
+    return pd.DataFrame({'user_id': index.user_ids[rows], 'similarity': sims})
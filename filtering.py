@@ -1,9 +1,36 @@
 import re
-import pymorphy3
+import json
+import threading
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
-morph = pymorphy3.MorphAnalyzer()
+from fs_utils import atomic_write
+from tracing import span, count
+
+CITY_INDEX_PATH = 'city_index.json'
+SEX_LABELS = {1: 'Женский', 2: 'Мужской'}  # коды пола VK → значения фильтра
+
+_morph = None
+_morph_lock = threading.Lock()
+
+
+def get_morph():
+    """MorphAnalyzer создаётся один раз, при первом обращении (загрузка словарей заметна на старте)."""
+    global _morph
+    if _morph is None:
+        with _morph_lock:
+            if _morph is None:
+                import pymorphy3
+                _morph = pymorphy3.MorphAnalyzer()
+    return _morph
+
+
+@lru_cache(maxsize=100_000)
+def normal_form(word: str) -> str:
+    """Нормальная форма слова (morph.parse — дорогой вызов, поэтому мемоизируем)."""
+    return get_morph().parse(word)[0].normal_form
 
 # 1) Демонимы (в нормальной форме) → канонический город
 DEMONYMS_RAW = {
@@ -13,10 +40,12 @@ DEMONYMS_RAW = {
     'свердловчанин':   'Екатеринбург',
     # ... 
 }
-DEMONYMS = {
-    morph.parse(demon)[0].normal_form: city
-    for demon, city in DEMONYMS_RAW.items()
-}
+
+
+@lru_cache(maxsize=None)
+def get_demonyms() -> dict:
+    """Демонимы в нормальной форме → город (считается при первом построении индекса)."""
+    return {normal_form(demon): city for demon, city in DEMONYMS_RAW.items()}
 
 # 2) Синонимы / варианты написания города → каноническое имя
 CITY_SYNONYMS_RAW = {
@@ -55,46 +84,131 @@ def init_city_lemmas(city_list: list[str]) -> dict[str, set[str]]:
     city_lemmas: dict[str, set[str]] = {}
     for city in city_list:
         toks = _tokenize(city)
-        city_lemmas[city] = {morph.parse(tok)[0].normal_form for tok in toks}
+        city_lemmas[city] = {normal_form(tok) for tok in toks}
     return city_lemmas
 
 
-def parse_city(
-    query: str,
-    city_list: list[str],
-    city_lemmas: dict[str, set[str]]
-) -> str | None:
+def _raw_version() -> str:
+    """Отпечаток словарей демонимов/синонимов: при их изменении индекс строится заново."""
+    return json.dumps([DEMONYMS_RAW, CITY_SYNONYMS_RAW], ensure_ascii=False, sort_keys=True)
+
+
+def build_city_index(city_list: list[str]) -> dict:
+    """
+    Инвертированный индекс для parse_city:
+      'demonyms': лемма демонима → город,
+      'synonyms': вариант написания → город,
+      'lemmas':   лемма слова из названия → список городов (в порядке добавления),
+      'cities':   уже проиндексированные города.
+    """
+    index = {
+        'version': _raw_version(),
+        'demonyms': dict(get_demonyms()),
+        'synonyms': dict(CANONICAL),
+        'lemmas': {},
+        'cities': [],
+    }
+    update_city_index(index, city_list)
+    return index
+
+
+def update_city_index(index: dict, city_list: list[str]) -> bool:
+    """Добавляет в индекс новые города. Возвращает True, если индекс изменился."""
+    known = set(index['cities'])
+    changed = False
+    for city in city_list:
+        if city in known:
+            continue
+        known.add(city)
+        index['cities'].append(city)
+        for lem in init_city_lemmas([city])[city]:
+            index['lemmas'].setdefault(lem, []).append(city)
+        changed = True
+    return changed
+
+
+def load_city_index(path: str = CITY_INDEX_PATH) -> dict | None:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return index if index.get('version') == _raw_version() else None
+
+
+def save_city_index(index: dict, path: str = CITY_INDEX_PATH) -> None:
+    with atomic_write(path) as f:
+        json.dump(index, f, ensure_ascii=False)
+
+
+_city_index = None
+_city_index_lock = threading.Lock()
+
+def get_city_index(city_list: list[str], path: str | None = CITY_INDEX_PATH) -> dict:
+    """
+    Индекс городов процесса: загружается с диска один раз, новые города
+    из city_list доиндексируются и сохраняются инкрементально.
+    """
+    global _city_index
+    with _city_index_lock:
+        if _city_index is None:
+            _city_index = (load_city_index(path) if path else None) or build_city_index([])
+        if update_city_index(_city_index, city_list) and path:
+            save_city_index(_city_index, path)
+        return _city_index
+
+
+def parse_city(query: str, city_index: dict) -> str | None:
     """
-    Ищет в запросе упоминание города и возвращает точное имя из city_list,
-    либо None. Логика:
+    Ищет в запросе упоминание города и возвращает точное имя из индекса
+    (build_city_index), либо None. Логика:
       1) Демонимы: "москвичи", "питерцы" → сразу Москва/S-P
       2) Синонимы: "питер", "свердловск" → S-P/Екб
-      3) Прямое лемматизированное вхождение: если лемма токена
-         совпадает с леммой любого слова из названия города.
+      3) Прямое лемматизированное вхождение: лемма токена совпадает
+         с леммой слова из названия города; при нескольких кандидатах
+         выбирается город с наибольшим числом совпавших лемм.
+    Время разбора зависит от длины запроса, а не от числа городов.
     """
     tokens = _tokenize(query)
-    lemmas = [morph.parse(tok)[0].normal_form for tok in tokens]
+    lemmas = [normal_form(tok) for tok in tokens]
 
     # 1) Демонимы
     for lem in lemmas:
-        if lem in DEMONYMS:
-            return DEMONYMS[lem]
+        if lem in city_index['demonyms']:
+            return city_index['demonyms'][lem]
 
     # 2) Синонимы
     for tok in tokens:
-        if tok in CANONICAL:
-            return CANONICAL[tok]
+        if tok in city_index['synonyms']:
+            return city_index['synonyms'][tok]
 
     # 3) Прямой лемматизированный match
-    lemma_set = set(lemmas)
-    for city, lem_set in city_lemmas.items():
-        # если хоть одна лемма из названия города встречается в запросе
-        if lemma_set & lem_set:
-            return city
+    hits: dict[str, int] = {}
+    for lem in dict.fromkeys(lemmas):
+        for city in city_index['lemmas'].get(lem, ()):
+            hits[city] = hits.get(city, 0) + 1
+    if hits:
+        return max(hits, key=hits.get)
 
     # ничего не нашли
     return None
 
+def query_cities(query: str, lookup) -> list[str]:
+    """
+    Города из внешнего справочника для запроса: lookup(words) → названия
+    (например, vk_utils.vk_find_cities). Остаются только города, все слова
+    названия которых есть в запросе, — «Белая Калитва» не найдётся по «белые».
+    Так город разбирается и тогда, когда его ещё нет среди сохранённых пользователей.
+    """
+    tokens = [tok for tok in _tokenize(query) if len(tok) > 2 and not tok.isdigit()]
+    if not tokens:
+        return []
+    lemmas = {normal_form(tok) for tok in tokens}
+    # справочник ищет по началу названия: «новгороде» не найдёт, а лемма «новгород» — найдёт
+    titles = lookup(list(dict.fromkeys(tokens + sorted(lemmas))))
+    return [city for city, city_lemmas in init_city_lemmas(titles).items() if city_lemmas <= lemmas]
+
+
 def parse_gender(query: str):
     q = query.lower()
 
@@ -152,11 +266,55 @@ def calculate_age(bdate_str):
     except:
         return None
 
-def filter_by_query(query: str, df: pd.DataFrame):
-    # 0) предварительно рассчитываем возраст один раз
-    if 'age' not in df.columns:
-        df['age'] = df['bdate'].apply(calculate_age)
+def compute_ages(bdate: pd.Series, today=None) -> pd.Series:
+    """
+    Векторный расчёт возраста по колонке bdate ("Д.М.ГГГГ" или "М.ГГГГ").
+    Возвращает nullable Int8; без года или с некорректной датой — <NA>.
+    Разбираются только уникальные значения bdate, затем результат
+    разворачивается обратно по кодам.
+    """
+    today = today or datetime.today()
+    codes, uniques = pd.factorize(bdate)
+    parts = pd.Series(uniques, dtype='string').str.split('.', expand=True).reindex(columns=range(3))
+    n_parts = parts.notna().sum(axis=1)
+    full = n_parts == 3
+    # "М.ГГГГ" — день считаем первым числом месяца, как в calculate_age
+    day = pd.to_numeric(parts[0].where(full, '1'), errors='coerce').astype(float)
+    month = pd.to_numeric(parts[1].where(full, parts[0]), errors='coerce').astype(float)
+    year = pd.to_numeric(parts[2].where(full, parts[1]), errors='coerce').astype(float)
+    year = year.where((n_parts >= 2) & (year >= 1900))
+    birth = pd.to_datetime(pd.DataFrame({'year': year, 'month': month, 'day': day}), errors='coerce')
+    before_birthday = (birth.dt.month > today.month) | (
+        (birth.dt.month == today.month) & (birth.dt.day > today.day))
+    age = today.year - birth.dt.year - before_birthday.astype(int)
+    age = age.where((age >= 0) & (age <= 127)).astype('Int8').array
+    # код -1 (пропуск в bdate) → <NA>
+    ages = age.take(codes, allow_fill=True) if len(age) else pd.array([pd.NA] * len(codes), dtype='Int8')
+    return pd.Series(ages, index=bdate.index, dtype='Int8')
+
+def prepare_audience(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Однократная подготовка аудитории к фильтрации: возраст (Int8),
+    пол и город — категориальные колонки. Изменяет df на месте.
+    """
+    if 'age' not in df.columns or df['age'].dtype != 'Int8':
+        df['age'] = compute_ages(df['bdate'])
+    for col in ('sex', 'city'):
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
 
+def _category_mask(col: pd.Series, value: str) -> np.ndarray:
+    """Точное (без учёта регистра) совпадение по категориальной колонке: сравниваем только категории."""
+    cats = col.cat.categories
+    hit = np.flatnonzero(cats.astype(str).str.lower() == value.lower())
+    return np.isin(col.cat.codes.to_numpy(), hit)
+
+def parse_query_filters(query: str, city_list: list[str]) -> dict:
+    """
+    Разбирает запрос в фильтры аудитории:
+    {'min_age', 'max_age', 'sex', 'city'} (None — без ограничения).
+    """
     # 1) возраст
     min_age, max_age = parse_age(query)
     print('Возрастной диапазон: от', min_age, 'до', max_age)
@@ -164,19 +322,59 @@ def filter_by_query(query: str, df: pd.DataFrame):
     gender = parse_gender(query)
     print('Пол запроса:', gender)
     # 3) город
-    city_list   = df['city'].dropna().unique().tolist()
-    city_lemmas = init_city_lemmas(city_list)
-    city        = parse_city(query, city_list, city_lemmas)
+    city = parse_city(query, get_city_index(city_list))
 
     print('Город:', city)
-    # 4) собственно фильтрация
-    res = df.copy()
-    if min_age is not None:
-        res = res[res['age'] >= min_age]
-    if max_age is not None:
-        res = res[res['age'] <= max_age]
-    if gender:
-        res = res[res['sex'] == gender]
-    if city:
-        res = res[res['city'].str.contains(city, case=False, na=False)]
-    return res
\ No newline at end of file
+    return {'min_age': min_age, 'max_age': max_age, 'sex': gender, 'city': city}
+
+def query_mask(query: str, df: pd.DataFrame, filters: dict | None = None) -> np.ndarray:
+    """
+    Булева маска строк df, подходящих под запрос (возраст, пол, город).
+    Все условия объединяются в одну маску без промежуточных копий df,
+    поэтому её можно применять и как пред-фильтр к индексу эмбеддингов.
+    filters — уже разобранный запрос (parse_query_filters), если есть.
+    """
+    # 0) возраст и категории считаем один раз (если df ещё не подготовлен)
+    prepare_audience(df)
+
+    if filters is None:
+        filters = parse_query_filters(query, df['city'].cat.categories.tolist())
+
+    # собственно фильтрация; считаем, сколько пользователей отсёк каждый фильтр
+    with span('filter.query_mask', rows=len(df)):
+        mask = np.ones(len(df), dtype=bool)
+        left = len(df)
+        steps = [
+            ('age', filters['min_age'] is not None,
+             lambda: (df['age'] >= filters['min_age']).to_numpy(dtype=bool, na_value=False)),
+            ('age', filters['max_age'] is not None,
+             lambda: (df['age'] <= filters['max_age']).to_numpy(dtype=bool, na_value=False)),
+            ('sex', bool(filters['sex']), lambda: _category_mask(df['sex'], filters['sex'])),
+            ('city', bool(filters['city']), lambda: _category_mask(df['city'], filters['city'])),
+        ]
+        for name, active, condition in steps:
+            if active:
+                mask &= condition()
+                kept = int(mask.sum())
+                count('filter.dropped.' + name, left - kept)
+                left = kept
+    return mask
+
+def filter_members(members: list[dict], filters: dict) -> list[dict]:
+    """
+    Участники со страницы groups.getMembers (сырые словари VK), подходящие
+    под фильтры запроса. Условия те же, что в query_mask, но проверяются
+    до запроса подписок — на неподходящих пользователей не тратим квоту.
+    """
+    if not members or not any(filters.get(k) is not None for k in ('min_age', 'max_age', 'sex', 'city')):
+        return members
+    df = pd.DataFrame({
+        'bdate': [m.get('bdate') for m in members],
+        'sex':   [SEX_LABELS.get(m.get('sex')) for m in members],
+        'city':  [(m.get('city') or {}).get('title') for m in members],
+    })
+    mask = query_mask('', df, filters)
+    return [m for m, ok in zip(members, mask) if ok]
+
+def filter_by_query(query: str, df: pd.DataFrame):
+    return df[query_mask(query, df)]
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, binary=False):
+    """
+    Файл для записи, который подменяет path целиком (os.replace) только после
+    успешного выхода из блока: читатели видят либо старое содержимое, либо
+    новое. Временный файл создаётся рядом с path с уникальным именем (mkstemp),
+    так что параллельные писатели — потоки и процессы — не делят его.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                               suffix='.tmp')
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@contextmanager
+def atomic_dir(path):
+    """
+    Каталог, собираемый во временном (mkdtemp рядом с path) и подменяющий
+    path целиком после успешного выхода из блока. Уже открытые memmap файлов
+    старого каталога остаются валидными: inode живут до закрытия.
+    """
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.')
+    try:
+        yield tmp
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if os.path.exists(path):
+        old = tmp + '.old'
+        os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(tmp, path)
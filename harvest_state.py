@@ -0,0 +1,120 @@
+"""
+Состояние сбора пользователей между запусками.
+
+SeenIndex — индекс уже обработанных пользователей VK: отсортированные
+массивы user_id (с полученными подписками и с закрытым профилем) в .npy,
+открываются через memmap. Проверка делается до запроса подписок, так что
+подписки уже сохранённых и заведомо закрытых профилей повторно не запрашиваются.
+
+Чекпоинт сборщика — JSON-снимок MemberSampler (взятые страницы, оценки долей,
+ещё не выданные страницы), необработанных участников и собранных пользователей.
+Перезапуск с теми же аргументами продолжает сбор с места снимка.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from fs_utils import atomic_write
+
+SEEN_DIR = 'seen_users'
+CHECKPOINT_DIR = 'checkpoints'
+CHECKPOINT_INTERVAL = 30    # секунд между снимками состояния сборщика
+PROCESSED, PRIVATE = 'processed', 'private'
+
+
+class SeenIndex:
+    """
+    Обработанные (PROCESSED) и закрытые (PRIVATE) user_id. Сохранённая часть —
+    отсортированные int64-массивы (поиск через searchsorted), новые id копятся
+    в множествах и вливаются в массивы при flush().
+    """
+
+    def __init__(self, path=SEEN_DIR):
+        self.path = path
+        self.arrays = {kind: self._load(kind) for kind in (PROCESSED, PRIVATE)}
+        self.added = {kind: set() for kind in (PROCESSED, PRIVATE)}
+        self.lock = threading.Lock()
+
+    def _file(self, kind):
+        return os.path.join(self.path, kind + '.npy')
+
+    def _load(self, kind):
+        try:
+            return np.load(self._file(kind), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return np.empty(0, dtype=np.int64)
+
+    @property
+    def stored(self):
+        """Есть ли индекс на диске (иначе его стоит заполнить из хранилища)."""
+        return os.path.exists(self._file(PROCESSED))
+
+    def __len__(self):
+        return sum(len(a) for a in self.arrays.values()) + sum(len(s) for s in self.added.values())
+
+    def _contains(self, kind, ids):
+        arr = self.arrays[kind]
+        found = np.zeros(len(ids), dtype=bool)
+        if len(arr):
+            pos = np.minimum(np.searchsorted(arr, ids), len(arr) - 1)
+            found = arr[pos] == ids
+        added = self.added[kind]
+        if added:
+            found |= np.fromiter((i in added for i in ids.tolist()), dtype=bool, count=len(ids))
+        return found
+
+    def unseen(self, user_ids):
+        """Маска user_ids, которых нет в индексе ни как обработанных, ни как закрытых."""
+        ids = np.asarray(user_ids, dtype=np.int64)
+        with self.lock:
+            return ~(self._contains(PROCESSED, ids) | self._contains(PRIVATE, ids))
+
+    def add(self, user_ids, kind=PROCESSED):
+        with self.lock:
+            self.added[kind].update(int(i) for i in user_ids)
+
+    def flush(self):
+        """Вливает новые id в отсортированные массивы и атомарно перезаписывает файлы."""
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            for kind, added in self.added.items():
+                if not added and os.path.exists(self._file(kind)):
+                    continue
+                # на диске могли появиться id другого запуска (сервер, параллельный сбор) — не теряем их
+                merged = np.union1d(np.union1d(self._load(kind), self.arrays[kind]),
+                                    np.fromiter(added, dtype=np.int64, count=len(added)))
+                with atomic_write(self._file(kind), binary=True) as f:
+                    np.save(f, merged.astype(np.int64))
+                self.arrays[kind] = np.load(self._file(kind), mmap_mode='r')
+                added.clear()
+
+
+def checkpoint_path(*key, directory=CHECKPOINT_DIR):
+    """Файл чекпоинта для сбора с данными аргументами (группы, n_target, запрос...)."""
+    digest = hashlib.sha1(json.dumps(key, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest + '.json')
+
+
+def load_checkpoint(path):
+    if not path:
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_checkpoint(path, state):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with atomic_write(path) as f:
+        json.dump(state, f, ensure_ascii=False)
+
+
+def drop_checkpoint(path):
+    """Сбор завершён — снимок больше не нужен."""
+    if path and os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,455 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from embeddings import (GroupScorer, build_user_embeddings, build_user_profiles, flush_nearest_cache, get_prompt_embedding,
+                        load_embeddings, recommend_from_index)
+from filtering import SEX_LABELS, filter_members, parse_query_filters, prepare_audience, query_cities, query_mask
+from harvest_state import (CHECKPOINT_INTERVAL, PRIVATE, SEEN_DIR, SeenIndex, checkpoint_path, drop_checkpoint,
+                           load_checkpoint, save_checkpoint)
+from user_index import write_index
+from user_store import (count_users, open_store, open_store_with_import, upsert_users, distinct_cities, iter_users,
+                        save_profiles, stored_user_ids, users_by_id)
+from tfidf_store import load_tfidf
+from tracing import count, span, traced, memory_snapshot
+from vk_utils import EXECUTE_BATCH, MemberSampler, get_users_groups_batch, make_user_record, vk_find_cities
+
+QUEUE_SIZE = 1000       # пользователей в очереди между стадиями
+SUB_WORKERS = 4         # параллельных пачек users.getSubscriptions
+EMBED_BATCH = 256       # пользователей на один пакетный расчёт эмбеддингов
+NEAREST_CACHE = 'groups_nearest.json'   # ближайшие по TF-IDF группы для групп без эмбеддинга
+USER_INDEX_DIR = 'user_index'           # квантованный индекс эмбеддингов всех пользователей хранилища
+
+
+@traced('pipeline.load_resources')
+def load_resources(groups_csv='groups_clean.csv', emb_path='groups'):
+    """Метаданные групп, TF-IDF (из кэша артефактов) и эмбеддинги групп — всё, что нужно стадии эмбеддингов."""
+    groups_meta, vectorizer, tfidf_matrix = load_tfidf(groups_csv)
+    emb_map = load_embeddings(emb_path)
+    return groups_meta, vectorizer, tfidf_matrix, emb_map
+
+
+@traced('pipeline.build_user_index')
+def build_user_index(resources, store_path='users.db', path=USER_INDEX_DIR, chunksize=50_000, n_lists=None):
+    """
+    Индекс всех пользователей хранилища для rank_stored_users. Эмбеддинги
+    (build_user_embeddings) считаются блоками по chunksize пользователей и сразу
+    квантуются в файлы индекса (user_index.write_index), так что (N, dim)-матрица
+    целиком в памяти не нужна. n_lists — построить и IVF-разбиение для n_probe.
+    """
+    groups_meta, vectorizer, tfidf_matrix, emb_map = resources
+    conn = open_store(store_path)
+    try:
+        chunks = (build_user_embeddings(df, emb_map, groups_meta, vectorizer, tfidf_matrix, cache_path=NEAREST_CACHE)
+                  for df in iter_users(conn, chunksize=chunksize))
+        index = write_index(path, chunks, capacity=count_users(conn))
+    finally:
+        conn.close()
+        flush_nearest_cache(NEAREST_CACHE)
+    if n_lists and len(index):
+        index.build_ivf(n_lists=n_lists).save_ivf(path)
+    return index
+
+
+@traced('pipeline.rank_stored_users')
+def rank_stored_users(query, index, store_path='users.db', top_k=5, n_probe=None, prompt=None):
+    """
+    Топ уже собранных пользователей по индексу (build_user_index) — без сбора
+    из VK. Фильтры запроса (возраст, пол, город) — пред-маска строк индекса:
+    подходящие user_id выбираются в SQLite и уточняются query_mask.
+    prompt — текст для эмбеддинга (по умолчанию сам запрос).
+    Возвращает DataFrame user_id, city, age, gender, similarity.
+    """
+    conn = open_store(store_path)
+    try:
+        filters = parse_query_filters(query, distinct_cities(conn))
+        mask = None
+        if any(v is not None for v in filters.values()):
+            matching = [np.empty(0, dtype=np.int64)]
+            for df in iter_users(conn, with_groups=False, **filters):
+                df['sex'] = df['sex'].map(SEX_LABELS)
+                matching.append(df['user_id'].to_numpy(dtype=np.int64)[query_mask(query, df, filters)])
+            mask = np.isin(index.user_ids, np.concatenate(matching))
+        top = recommend_from_index(index, prompt or query, top_k=top_k, mask=mask, n_probe=n_probe)
+        meta = users_by_id(conn, top['user_id'])
+    finally:
+        conn.close()
+    meta['sex'] = meta['sex'].map(SEX_LABELS)
+    prepare_audience(meta)
+    top = top.merge(meta[['user_id', 'city', 'age', 'sex']].rename(columns={'sex': 'gender'}), on='user_id', how='left')
+    return top[['user_id', 'city', 'age', 'gender', 'similarity']]
+
+
+class TopK:
+    """
+    Текущий top-k по similarity (min-heap размера k). Записи хранят группы
+    пользователя и норму профиля; объяснения (explain(groups, norm), например
+    GroupScorer.explain) строятся в frame() — только для попавших в топ.
+    """
+
+    def __init__(self, k, explain=None):
+        self.k = k
+        self.explain = explain
+        self.heap = []
+        self.seen = set()
+
+    def candidates(self, user_ids, sims):
+        """Строки пакета, которые могут попасть в топ: k лучших из ещё не виденных пользователей."""
+        rows = np.flatnonzero(~np.isin(user_ids, np.fromiter(self.seen, dtype=np.int64, count=len(self.seen))))
+        return rows[np.argsort(-sims[rows], kind='stable')[:self.k]]
+
+    def push(self, sims, records):
+        changed = False
+        for sim, rec in zip(sims, records):
+            if rec['user_id'] in self.seen:
+                continue
+            self.seen.add(rec['user_id'])
+            item = (float(sim), rec['user_id'], rec)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+                changed = True
+            elif item[:2] > self.heap[0][:2]:
+                heapq.heapreplace(self.heap, item)
+                changed = True
+        return changed
+
+    def frame(self):
+        rows = [dict(rec, similarity=sim,
+                     top_groups=self.explain(rec['groups'], rec['norm']) if self.explain else [])
+                for sim, _, rec in sorted(self.heap, key=lambda x: x[:2], reverse=True)]
+        return pd.DataFrame(rows, columns=['user_id', 'city', 'age', 'gender', 'similarity', 'top_groups'])
+
+
+def stored_profiles(df):
+    """Профили (user_ids, indptr, group_ids, norms) из колонок emb_groups/emb_norm хранилища."""
+    lists = df['emb_groups'].tolist()
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(g) for g in lists], out=indptr[1:])
+    group_ids = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int64, count=int(indptr[-1]))
+    return df['user_id'].to_numpy(dtype=np.int64), indptr, group_ids, df['emb_norm'].to_numpy(dtype=np.float32)
+
+
+def concat_profiles(parts):
+    user_ids, indptr, group_ids, norms = [], [np.zeros(1, dtype=np.int64)], [], []
+    offset = 0
+    for uids, ptr, gids, nrm in parts:
+        user_ids.append(uids)
+        indptr.append(ptr[1:] + offset)
+        group_ids.append(gids)
+        norms.append(nrm)
+        offset += int(ptr[-1])
+    return (np.concatenate(user_ids) if user_ids else np.empty(0, dtype=np.int64), np.concatenate(indptr),
+            np.concatenate(group_ids) if group_ids else np.empty(0, dtype=np.int64),
+            np.concatenate(norms) if norms else np.empty(0, dtype=np.float32))
+
+
+async def stream_users(groups, n_target, q_users, executor, predicate=None, seen=None, checkpoint=None,
+                       api=None, workers=SUB_WORKERS):
+    """
+    Сборщик пользователей: участники групп (MemberSampler) → подписки пачками
+    по EXECUTE_BATCH пользователей (один execute) в workers параллельных задачах;
+    темп запросов ограничивает VkApiPool. Пачки записей новых пользователей
+    кладутся в q_users, в конце — None. Как только набрано n_target, запросы
+    «в полёте» не дожидаемся.
+    predicate(members) отбирает участников по странице getMembers — подписки
+    запрашиваются и n_target считается только для подходящих.
+    seen — SeenIndex: пользователи из него пропускаются, новые в него добавляются.
+    checkpoint — путь чекпоинта (harvest_state.checkpoint_path): состояние
+    семплера, собранные user_id и участники, ещё не получившие подписок,
+    сохраняются раз в CHECKPOINT_INTERVAL секунд и при ошибке или отмене;
+    перезапуск с тем же путём продолжает сбор, после завершения файл удаляется.
+    Возвращает user_id собранных (вместе с собранными до перезапуска).
+    """
+    loop = asyncio.get_running_loop()
+
+    def in_pool(fn, *args):
+        return loop.run_in_executor(executor, fn, *args)
+
+    sampler = MemberSampler(groups, n_target, api=api, predicate=predicate)
+    state = load_checkpoint(checkpoint)
+    if state:
+        sampler.restore(state['sampler'])
+        count('vk.checkpoint_resumed')
+    collected = state['collected'] if state else []
+    # участники, выданные семплером, но ещё без подписок (в очереди и «в полёте»)
+    backlog = {u['id']: u for u in state['backlog']} if state else {}
+    q_members = asyncio.Queue(QUEUE_SIZE)
+    stop = asyncio.Event()
+    saved_at = time.monotonic()
+
+    def snapshot_state():
+        # копии снимаются в потоке цикла событий: воркеры в это время их не меняют
+        return {'sampler': sampler.state(), 'collected': list(collected), 'backlog': list(backlog.values())}
+
+    def save(state):
+        save_checkpoint(checkpoint, state)
+        if seen is not None:
+            seen.flush()
+
+    async def harvest():
+        for u in list(backlog.values()):
+            await q_members.put(u)
+        pages = sampler.iter_pages()
+        while (members := await in_pool(next, pages, None)) is not None:
+            if seen is not None:
+                fresh = seen.unseen([u['id'] for u in members])
+                count('vk.users_seen_skipped', int((~fresh).sum()))
+                members = list(itertools.compress(members, fresh))
+            for u in members:
+                backlog[u['id']] = u
+                await q_members.put(u)
+        # сигналы конца — только при нормальном завершении: при отмене (stop или
+        # упавшие воркеры) их некому читать, а put в полную очередь повис бы навсегда
+        for _ in range(workers):
+            await q_members.put(None)
+
+    async def fetch_subscriptions():
+        nonlocal saved_at
+        while not stop.is_set():
+            u = await q_members.get()
+            if u is None:
+                return
+            batch = [u]
+            while len(batch) < EXECUTE_BATCH and not q_members.empty():
+                nxt = q_members.get_nowait()
+                if nxt is None:
+                    q_members.put_nowait(None)  # вернём сигнал для следующего воркера
+                    break
+                batch.append(nxt)
+            private = set()
+            groups_by_user = await in_pool(get_users_groups_batch, [m['id'] for m in batch], api, private)
+            records = [make_user_record(m, groups_by_user[m['id']]) for m in batch
+                       if groups_by_user.get(m['id']) is not None]
+            sampler.record(len(batch), len(records))
+            records = records[:max(0, n_target - len(collected))]
+            collected.extend(r['user_id'] for r in records)
+            for m in batch:
+                backlog.pop(m['id'], None)
+            if seen is not None:
+                # обработанными считаем только сохраняемых: лишние сверх n_target пригодятся в следующий раз
+                seen.add([r['user_id'] for r in records])
+                seen.add(private, PRIVATE)
+            if records:
+                await q_users.put(records)
+            if len(collected) >= n_target:
+                stop.set()
+            elif checkpoint and time.monotonic() - saved_at > CHECKPOINT_INTERVAL:
+                await in_pool(save, snapshot_state())
+                saved_at = time.monotonic()
+
+    completed = False
+    try:
+        harvest_task = asyncio.create_task(harvest())
+        tasks = [asyncio.create_task(fetch_subscriptions()) for _ in range(workers)]
+        stop_task = asyncio.create_task(stop.wait())
+        pending = {harvest_task, *tasks}
+        while pending & set(tasks) and not stop.is_set():
+            done, pending = await asyncio.wait(pending | {stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(stop_task)
+            # упал сборщик страниц или воркер — остальных останавливаем, ошибка поднимется ниже
+            if any(not t.cancelled() and t.exception() is not None for t in done - {stop_task}):
+                break
+        # набрали n_target (или ошибка) — запросы «в полёте» не дожидаемся
+        for task in (harvest_task, stop_task, *tasks):
+            task.cancel()
+        results = await asyncio.gather(harvest_task, *tasks, return_exceptions=True)
+        await q_users.put(None)
+        for r in results:
+            if isinstance(r, Exception) and not isinstance(r, asyncio.CancelledError):
+                raise r
+        completed = True
+    finally:
+        if checkpoint and not completed:
+            save(snapshot_state())
+        else:
+            drop_checkpoint(checkpoint)
+            if seen is not None:
+                seen.flush()
+    return collected
+
+
+def collect_users(groups, n_target, records=None, **kwargs):
+    """
+    Сбор без остальных стадий пайплайна (бенчмарки, тесты): stream_users со
+    своим пулом потоков; kwargs — как у stream_users. Записи пользователей
+    дописываются в records — при ошибке сбора там остаётся то, что успели
+    собрать. Возвращает records.
+    """
+    records = [] if records is None else records
+
+    async def run():
+        q_users = asyncio.Queue()
+        executor = ThreadPoolExecutor(max_workers=kwargs.get('workers', SUB_WORKERS) + 1)
+
+        async def drain():
+            while (batch := await q_users.get()) is not None:
+                records.extend(batch)
+
+        try:
+            await asyncio.gather(stream_users(groups, n_target, q_users, executor, **kwargs), drain())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    asyncio.run(run())
+    return records
+
+
+async def run_pipeline(query, groups, n_target=200, top_k=5, store_path='users.db',
+                       resources=None, on_update=None, seen_path=SEEN_DIR, checkpoint=True, executor=None):
+    """
+    Потоковый пайплайн: участники групп → подписки → фильтр → эмбеддинги → top-k.
+    Стадии связаны ограниченными очередями и работают одновременно: сетевые
+    вызовы VK и CPU-расчёты выполняются в пуле потоков, поэтому время работы
+    стремится ко времени самой медленной стадии. В рейтинг попадают и уже
+    сохранённые в хранилище пользователи, подходящие под запрос.
+    on_update(df) вызывается при каждом изменении текущего top-k.
+    Сбор — stream_users: подписки запрашиваются только у пользователей, которых
+    нет в SeenIndex (сохранённые и закрытые в прошлых запусках), а прерванный
+    запуск с тем же запросом продолжает сбор с чекпоинта.
+    executor — общий пул потоков (сервер); по умолчанию пул создаётся на запуск.
+    Возвращает DataFrame top-k с колонкой similarity.
+    """
+    pool = executor or ThreadPoolExecutor(max_workers=SUB_WORKERS + 4)
+    conns = []
+    try:
+        return await _run_pipeline(query, groups, n_target, top_k, store_path, resources, on_update,
+                                   seen_path, checkpoint, pool, conns)
+    finally:
+        if executor is None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        for conn in conns:
+            conn.close()
+
+
+async def _run_pipeline(query, groups, n_target, top_k, store_path, resources, on_update,
+                        seen_path, checkpoint, pool, conns):
+    """Тело run_pipeline; открытые соединения с хранилищем добавляются в conns."""
+    loop = asyncio.get_running_loop()
+
+    def in_pool(fn, *args):
+        return loop.run_in_executor(pool, fn, *args)
+
+    def connect(conn):
+        conns.append(conn)
+        return conn
+
+    conn = connect(open_store_with_import(store_path, 'users.json'))
+    # города — из хранилища и из справочника VK: на пустом хранилище город запроса
+    # иначе не разобрался бы, и фильтр по нему (и пред-фильтр участников) пропал бы
+    cities = distinct_cities(conn) + await in_pool(query_cities, query, vk_find_cities)
+    filters = parse_query_filters(query, cities)
+    seen = SeenIndex(seen_path)
+    if not seen.stored:
+        # индекса ещё нет — все пользователи хранилища уже обработаны
+        seen.add(stored_user_ids(conn))
+
+    # CPU-тяжёлая загрузка идёт параллельно со сбором из VK
+    resources_fut = in_pool(load_resources) if resources is None else None
+    prompt_fut = in_pool(get_prompt_embedding, query)
+
+    q_users = asyncio.Queue(QUEUE_SIZE)
+    q_filtered = asyncio.Queue(QUEUE_SIZE)
+    top = TopK(top_k)
+    ckpt = checkpoint_path(query, sorted(map(str, groups)), n_target) if checkpoint else None
+    # пол/возраст/город проверяем по странице участников — подписки только у подходящих
+    collect = stream_users(groups, n_target, q_users, pool, seen=seen, checkpoint=ckpt,
+                           predicate=lambda members: filter_members(members, filters))
+
+    async def filter_and_store():
+        while True:
+            records = await q_users.get()
+            if records is None:
+                await q_filtered.put(None)
+                return
+            await in_pool(upsert_users, conn, records)
+            df = pd.DataFrame(records)
+            df['sex'] = df['sex'].map(SEX_LABELS)
+            prepare_audience(df)
+            df = df[query_mask(query, df, filters)]
+            if len(df):
+                await q_filtered.put(df)
+
+    async def stored_users():
+        # пользователи из прошлых запусков, подходящие под фильтры запроса
+        # отдельное соединение: основное в это время пишет новых пользователей
+        chunks = iter_users(connect(open_store(store_path)), **filters)
+        while (df := await in_pool(next, chunks, None)) is not None:
+            df['sex'] = df['sex'].map(SEX_LABELS)
+            prepare_audience(df)
+            df = df[query_mask(query, df, filters)]
+            if len(df):
+                await q_filtered.put(df)
+        await q_filtered.put(None)
+
+    def embed_and_score(df, res, scorer):
+        with span('pipeline.embed_and_score', users=len(df)):
+            return _embed_and_score(df, res, scorer)
+
+    def _embed_and_score(df, res, scorer):
+        # сходство считается по группам (GroupScorer): профили пользователей из
+        # хранилища уже посчитаны, для новых строятся здесь и сохраняются
+        groups_meta, vectorizer, tfidf_matrix, emb_map = res
+        df = df.drop_duplicates('user_id')
+        cached = df['emb_norm'].notna().to_numpy() if 'emb_norm' in df else np.zeros(len(df), dtype=bool)
+        fresh = None
+        parts = []
+        if (~cached).any():
+            fresh = build_user_profiles(df[~cached], emb_map, groups_meta, vectorizer, tfidf_matrix,
+                                        cache_path=NEAREST_CACHE)
+            parts.append(fresh)
+        if cached.any():
+            parts.append(stored_profiles(df[cached]))
+        user_ids, indptr, group_ids, norms = concat_profiles(parts)
+        if len(user_ids) == 0:
+            return [], [], fresh
+        sims = scorer.score_users(indptr, group_ids, norms)
+        # записи — только для строк, которые могут войти в топ (не больше k на пакет)
+        rows = top.candidates(user_ids, sims)
+        meta = df.set_index('user_id').loc[user_ids[rows]]
+        records = [{'user_id': int(user_ids[i]), 'city': city, 'age': age, 'gender': sex,
+                    'groups': group_ids[indptr[i]:indptr[i + 1]], 'norm': norms[i]}
+                   for i, city, age, sex in zip(rows, meta['city'], meta['age'], meta['sex'])]
+        return sims[rows], records, fresh
+
+    async def embed():
+        res = resources if resources is not None else await resources_fut
+        prompt_emb = await prompt_fut
+        # промпт × вся таблица эмбеддингов групп — один раз на запрос
+        scorer = await in_pool(GroupScorer, res[3], prompt_emb)
+        top.explain = scorer.explain
+        profile_conn = connect(open_store(store_path))
+        memory_snapshot('pipeline.resources_loaded')
+        producers = 2
+        while producers:
+            df = await q_filtered.get()
+            if df is None:
+                producers -= 1
+                continue
+            frames = [df]
+            while sum(map(len, frames)) < EMBED_BATCH and not q_filtered.empty():
+                nxt = q_filtered.get_nowait()
+                if nxt is None:
+                    producers -= 1
+                    continue
+                frames.append(nxt)
+            batch = pd.concat(frames, ignore_index=True)
+            sims, records, fresh = await in_pool(embed_and_score, batch, res, scorer)
+            if fresh is not None and len(fresh[0]):
+                await in_pool(save_profiles, profile_conn, *fresh)
+            if top.push(sims, records) and on_update:
+                on_update(top.frame())
+
+    try:
+        with span('pipeline.run', n_target=n_target):
+            collected, *_ = await asyncio.gather(collect, filter_and_store(), stored_users(), embed())
+    finally:
+        # найденные за запуск соседи групп — одной записью файла, а не на каждый пакет
+        flush_nearest_cache(NEAREST_CACHE)
+    memory_snapshot('pipeline.done')
+    print(f"Собрано новых пользователей: {len(collected)}")
+    return top.frame()
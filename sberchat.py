@@ -1,11 +1,48 @@
-from langchain_gigachat.chat_models import GigaChat
-from langchain.schema import HumanMessage, SystemMessage
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-giga = GigaChat(
-    credentials="<GIGACHAT_TOKEN>",
-    model="GigaChat-preview",
-    verify_ssl_certs=False
-)
+from fs_utils import atomic_write
+from tracing import span, count
+
+CACHE_DIR = 'gigachat_cache'
+CACHE_TTL = 7 * 24 * 3600  # секунд
+
+SYSTEM_PROMPT = '''
+        Ты — ассистент, задача которого — брать "сырой" пользовательский запрос 
+        и выдавать 4–5 уточнённых чётко сформулированных вариантов для поиска целевой аудитории. 
+        Фокусируйся на профессии, возрасте, поле, городе, интересах, образовании 
+        и доходе, когда это уместно. Не задавай вопросов — сразу предлагай варианты.
+        Пример:
+        Вход: «айтишники питер»
+        Выход:
+        1) «разработчики ПО 25–40 лет в Санкт-Петербурге»
+        2) «DevOps-инженеры и системные админы в СПб»
+        3) «студенты IT-специальностей вузов Санкт-Петербурга»
+        4) «frontend-разработчики с опытом 1–3 года в Питере»
+        5) «женщины-программисты 30–45 лет в Ленобласти»
+        '''
+
+giga = None  # клиент GigaChat; создаётся get_giga() при первом запросе
+_giga_lock = threading.Lock()
+
+
+def get_giga():
+    """Клиент GigaChat (и langchain) загружаются только при первом обращении."""
+    global giga
+    if giga is None:
+        with _giga_lock:
+            if giga is None:
+                from langchain_gigachat.chat_models import GigaChat
+                giga = GigaChat(
+                    credentials="<GIGACHAT_TOKEN>",
+                    model="GigaChat-preview",
+                    verify_ssl_certs=False
+                )
+    return giga
 
 
 def parse_suggestions(text):
@@ -25,51 +62,141 @@ def parse_suggestions(text):
             opts.append(rest.strip().strip('«»"'))
     return opts
 
-def refine_query(raw_query, max_attempts=3):
-    # системный промпт
-    msgs = [
-        SystemMessage(content='''
-        Ты — ассистент, задача которого — брать "сырой" пользовательский запрос 
-        и выдавать 4–5 уточнённых чётко сформулированных вариантов для поиска целевой аудитории. 
-        Фокусируйся на профессии, возрасте, поле, городе, интересах, образовании 
-        и доходе, когда это уместно. Не задавай вопросов — сразу предлагай варианты.
-        Пример:
-        Вход: «айтишники питер»
-        Выход:
-        1) «разработчики ПО 25–40 лет в Санкт-Петербурге»
-        2) «DevOps-инженеры и системные админы в СПб»
-        3) «студенты IT-специальностей вузов Санкт-Петербурга»
-        4) «frontend-разработчики с опытом 1–3 года в Питере»
-        5) «женщины-программисты 30–45 лет в Ленобласти»
-        ''')
-    ]
+def ask_choice(options):
+    """Показывает варианты в консоли; возвращает номер выбранного (0 — новая генерация, -1 — неверный ввод)."""
+    print("\nВозможные варианты:")
+    for i, opt in enumerate(options, start=1):
+        print(f"  {i}) {opt}")
+    print("  0) Попробовать ещё раз\n")
+
+    choice = input("Введите номер варианта (или 0 для новой генерации): ").strip()
+    if not choice.isdigit():
+        return -1
+    if 1 <= int(choice) <= len(options):
+        print(f"\nВы выбрали: «{options[int(choice) - 1]}»")
+    return int(choice)
+
+
+def normalize_query(text):
+    """Ключ кэша: регистр и пробелы не важны."""
+    return ' '.join(text.lower().split())
+
+
+def _cache_path(raw_query, cache_dir):
+    key = hashlib.sha1(normalize_query(raw_query).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+
+def _read_cache(path, ttl):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    # TTL отсчитывается от первой генерации, дописанные его не продлевают
+    return data if time.time() - data.get('created', 0) < ttl else None
+
+
+def load_cached(raw_query, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """Закэшированные генерации вариантов для запроса (уже с городом); [] — нет или истёк TTL."""
+    data = _read_cache(_cache_path(raw_query, cache_dir), ttl)
+    return data['generations'] if data else []
+
+
+_cache_lock = threading.Lock()
+
+
+def save_generation(raw_query, options, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """Дописывает генерацию к кэшу запроса; файл подменяется атомарно."""
+    path = _cache_path(raw_query, cache_dir)
+    with _cache_lock:
+        data = _read_cache(path, ttl) or {'query': normalize_query(raw_query),
+                                           'created': time.time(), 'generations': []}
+        if options in data['generations']:
+            return
+        data['generations'].append(options)
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump(data, f, ensure_ascii=False)
+
+
+def generate_options(raw_query):
+    """Одна генерация: системный промпт и запрос, без истории прошлых попыток."""
+    from langchain.schema import HumanMessage, SystemMessage
+
+    msgs = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=raw_query)]
+    with span('gigachat.generate'):
+        answer = get_giga()(msgs)
+    count('gigachat.calls')
+    return parse_suggestions(answer.content)
+
+
+def iter_generations(raw_query, n=3, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """
+    Генерации вариантов уточнения по мере готовности: сначала из дискового
+    кэша, затем недостающие до n — запрошенные у GigaChat одновременно;
+    каждая отдаётся, как только пришла. Пришедшие генерации (и те, до которых
+    выбор так и не дошёл) дописываются в кэш. cache_dir=None отключает кэш.
+    """
+    cached = load_cached(raw_query, cache_dir, ttl) if cache_dir else []
+    count('gigachat.cache_hit' if cached else 'gigachat.cache_miss')
+    yield from cached
+    missing = n - len(cached)
+    if missing <= 0:
+        return
+
+    def generate():
+        options = generate_options(raw_query)
+        if cache_dir and options:
+            save_generation(raw_query, options, cache_dir, ttl)
+        return options
+
+    pool = ThreadPoolExecutor(max_workers=missing)
+    futures = [pool.submit(generate) for _ in range(missing)]
+    pool.shutdown(wait=False)
+    for fut in as_completed(futures):
+        try:
+            yield fut.result()
+        except Exception as e:
+            count('gigachat.errors')
+            print(f"Ошибка GigaChat: {e}")
+
+
+def choose_first(options):
+    """Неинтерактивный выбор: первый вариант (или новая генерация, если вариантов нет)."""
+    return 1 if options else 0
+
+
+def refine_query(raw_query, max_attempts=3, return_options=False, choose=None, cache_dir=CACHE_DIR):
+    """
+    Уточнение запроса через GigaChat. choose(options) возвращает номер выбранного
+    варианта (1..n) или 0 для новой генерации; по умолчанию — выбор в консоли
+    (ask_choice), для неинтерактивного режима — choose_first или своя функция.
+    max_attempts генераций запрашиваются сразу и параллельно, поэтому «ещё раз»
+    не стоит нового запроса; повторный запрос берётся из кэша (cache_dir).
+    """
+    choose = choose or ask_choice
     attempts = 0
-    while attempts < max_attempts:
-        msgs.append(HumanMessage(content=raw_query))
-        answer = giga(msgs)
-        options = parse_suggestions(answer.content)
-        
-        # Покажем варианты пользователю
-        print("\nВозможные варианты:")
-        for i, opt in enumerate(options, start=1):
-            print(f"  {i}) {opt}")
-        print("  0) Попробовать ещё раз\n")
-        
-        choice = input("Введите номер варианта (или 0 для новой генерации): ").strip()
-        if choice == '0':
-            attempts += 1
-            print(f"Повторная генерация ({attempts}/{max_attempts})...\n")
-            continue
-        if choice.isdigit() and 1 <= int(choice) <= len(options):
-            selected = options[int(choice) - 1]
-            print(f"\nВы выбрали: «{selected}»")
-            return selected
-        else:
+    first = []
+    for options in iter_generations(raw_query, n=max_attempts, cache_dir=cache_dir):
+        first = first or options
+        choice = choose(options)
+        while choice != 0 and not 1 <= choice <= len(options):
             print("Неверный ввод, попробуйте снова.")
-    
-    # Если попытки исчерпаны — по умолчанию берём первый вариант
+            choice = choose(options)
+        if choice:
+            selected = options[choice - 1]
+            return (selected, options) if return_options else selected
+        attempts += 1
+        if attempts >= max_attempts:
+            break
+        print(f"Повторная генерация ({attempts}/{max_attempts})...\n")
+
+    # Если попытки исчерпаны — по умолчанию берём первый вариант (или сам запрос, если вариантов нет)
     print("Максимум попыток исчерпан — используем первый вариант.")
-    return options[0]
+    selected = first[0] if first else raw_query
+    return (selected, first) if return_options else selected
+
 
 # Функция-детектор «поблизости»
 def needs_location(query):
@@ -82,14 +209,14 @@ def ask_user_location():
     return input("Похоже, вы ищете что-то поблизости. Укажите, пожалуйста, ваш город или район: ").strip()
 
 # Обёртка, которая сначала проверяет запрос, потом вызывает refine_query
-def refine_with_location(raw_query):
+def refine_with_location(raw_query, return_options=False, location=None, choose=None):
     if needs_location(raw_query):
-        city = ask_user_location()
+        city = location if location is not None else ask_user_location()
         # Подставляем город в запрос. Если в raw_query уже есть предлог,
         # просто добавляем в конец:
-        raw_query = f"{raw_query} {city}"
+        raw_query = f"{raw_query} {city}".strip()
     # Теперь точно передаём «сырый» (но уже с городом) запрос в LLM-рефайнер
-    return refine_query(raw_query)
+    return refine_query(raw_query, return_options=return_options, choose=choose)
 
 # Пример использования:
 if __name__ == "__main__":
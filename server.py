@@ -0,0 +1,210 @@
+"""
+Серверный режим: метаданные групп, TF-IDF, эмбеддинги групп и модель
+загружаются один раз при старте, запрос → топ пользователей доступен
+как локальный HTTP/JSON API. Запросы выполняет пул воркеров.
+
+    python server.py --port 8000 --workers 4
+
+    POST /refine  {"query": "айтишники рядом", "location": "Казань"}
+                  → {"raw_query", "options"}
+    POST /search  {"query": "девушки казань", "location": null, "option": 1,
+                   "refined": null, "n_target": 200, "top_k": 5, "pages": 3}
+                  → {"refined", "options", "groups", "top", "seconds"}
+    POST /rank    {"query": "девушки казань", "prompt": null, "top_k": 5, "n_probe": null}
+                  → {"top", "seconds"} — по индексу уже собранных пользователей, без VK
+    POST /reindex {"n_lists": null} → {"users", "seconds"} — перестроить этот индекс
+    GET  /health
+    GET  /stats   (?reset=1 — обнулить после чтения)
+                  → {"stages", "counters"} — сводка tracing с запуска или прошлого сброса
+
+Интерактивные шаги main.py стали параметрами: location — город для запросов
+«рядом/поблизости», option — номер варианта уточнения (1..n), refined — готовый
+уточнённый запрос (GigaChat не вызывается), "refine": false — без уточнения.
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from embeddings import get_model
+from filtering import get_morph
+from pipeline import (SUB_WORKERS, USER_INDEX_DIR, build_user_index, load_resources, rank_stored_users,
+                      run_pipeline)
+from sberchat import choose_first, needs_location, refine_query
+from user_index import UserIndex
+from user_store import open_store_with_import
+from yandex_search import search_vk_groups
+import tracing
+
+SEARCH_PAGES = 3
+MAX_BODY = 1024 * 1024
+
+
+def with_location(query, location):
+    """Запрос с подставленным городом; для запросов «рядом» без location — ValueError."""
+    if not needs_location(query):
+        return query
+    if not location:
+        raise ValueError("Запрос про «рядом/поблизости»: укажите параметр location (город или район)")
+    return f"{query} {location}"
+
+
+def _query(params):
+    query = str(params.get('query') or '').strip()
+    if not query:
+        raise ValueError("Пустой запрос: укажите параметр query")
+    return query
+
+
+def refine(params):
+    """Варианты уточнения запроса (без выбора) — чтобы аналитик выбрал option для /search."""
+    raw_query = with_location(_query(params), params.get('location'))
+    _, options = refine_query(raw_query, return_options=True, choose=choose_first)
+    return {'raw_query': raw_query, 'options': options}
+
+
+def search(params, resources, executor=None):
+    """Полный цикл main.py без input(): уточнение → поиск групп → пайплайн."""
+    start = time.perf_counter()
+    query = _query(params)
+    raw_query = with_location(query, params.get('location'))
+    option = int(params.get('option', 1))
+    refined, options = params.get('refined'), []
+    if not refined and params.get('refine', True):
+        refined, options = refine_query(raw_query, return_options=True,
+                                        choose=lambda opts: min(max(option, 1), len(opts)))
+
+    urls, groups = search_vk_groups([query, refined, *options], pages=int(params.get('pages', SEARCH_PAGES)))
+    result = {'refined': refined, 'options': options, 'groups': groups, 'top': []}
+    if groups:
+        top = asyncio.run(run_pipeline(query, groups, n_target=int(params.get('n_target', 200)),
+                                       top_k=int(params.get('top_k', 5)), resources=resources,
+                                       executor=executor))
+        # to_json, а не to_dict: возраст — nullable Int8, pd.NA не сериализуется json
+        result['top'] = json.loads(top.to_json(orient='records', force_ascii=False))
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def rank(params, server):
+    """Топ пользователей хранилища по квантованному индексу (pipeline.rank_stored_users)."""
+    start = time.perf_counter()
+    if server.user_index is None:
+        raise ValueError("Индекс пользователей ещё не построен: вызовите POST /reindex")
+    n_probe = params.get('n_probe')
+    top = rank_stored_users(_query(params), server.user_index, top_k=int(params.get('top_k', 5)),
+                            n_probe=int(n_probe) if n_probe else None, prompt=params.get('prompt'))
+    return {'top': json.loads(top.to_json(orient='records', force_ascii=False)),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+def reindex(params, server):
+    """Перестраивает индекс по всему хранилищу; поиск до замены идёт по старому."""
+    start = time.perf_counter()
+    n_lists = params.get('n_lists')
+    with server.index_lock:
+        server.user_index = build_user_index(server.resources, n_lists=int(n_lists) if n_lists else None)
+    return {'users': len(server.user_index), 'seconds': round(time.perf_counter() - start, 3)}
+
+
+def warm_up(store_path='users.db'):
+    """Всё, что не зависит от запроса: ресурсы эмбеддингов, модель, морфология, хранилище."""
+    with tracing.span('server.warm_up'):
+        resources = load_resources()
+        get_model()
+        get_morph()
+        # импорт users.json (если хранилища ещё нет) — до параллельных запросов
+        open_store_with_import(store_path, 'users.json').close()
+    return resources
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'osint/1.0'
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok', 'workers': self.server.workers})
+        elif self.path in ('/stats', '/stats?reset=1'):
+            self._send(200, {'stages': tracing.summary(), 'counters': tracing.counters()})
+            if self.path.endswith('reset=1'):
+                tracing.reset()
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        routes = {
+            '/search': lambda params: search(params, self.server.resources, self.server.stage_pool),
+            '/refine': refine,
+            '/rank': lambda params: rank(params, self.server),
+            '/reindex': lambda params: reindex(params, self.server),
+        }
+        handler = routes.get(self.path)
+        if handler is None:
+            self._send(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self._send(413, {'error': 'request too large'})
+            return
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(params, dict):
+                raise ValueError("Ожидается JSON-объект")
+            # соединения принимает ThreadingHTTPServer, а сама работа — в ограниченном пуле
+            result = self.server.pool.submit(handler, params).result()
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            tracing.count('server.errors')
+            self._send(500, {'error': f"{type(e).__name__}: {e}"})
+        else:
+            self._send(200, result)
+
+
+def serve(host='127.0.0.1', port=8000, workers=4):
+    # отдельные спаны в сервере не нужны (трейс никто не выгружает) и копились бы
+    # с каждым запросом; сводка по стадиям и счётчики — фиксированного размера
+    tracing.record_spans(False)
+    resources = warm_up()
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.resources = resources
+    httpd.user_index = UserIndex.load(USER_INDEX_DIR) if os.path.exists(USER_INDEX_DIR) else None
+    httpd.index_lock = threading.Lock()
+    httpd.workers = workers
+    httpd.pool = ThreadPoolExecutor(max_workers=workers)
+    # потоки стадий пайплайна — общие для всех запросов, а не новый пул на каждый
+    httpd.stage_pool = ThreadPoolExecutor(max_workers=workers * (SUB_WORKERS + 4))
+    print(f"Сервер запущен: http://{host}:{port} (воркеров: {workers})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        httpd.pool.shutdown(wait=False, cancel_futures=True)
+        httpd.stage_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4, help='одновременно обрабатываемых запросов')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == '__main__':
+    main()
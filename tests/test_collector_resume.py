@@ -0,0 +1,45 @@
+import pytest
+
+import vk_utils
+from bench.fake_vk import FakeVkSession, QuotaExceeded
+from harvest_state import SeenIndex, checkpoint_path, load_checkpoint
+from pipeline import SUB_WORKERS, collect_users
+
+GROUPS = [1, 2, 3]
+N_TARGET = 200
+
+
+def collect(tmp_path, records, fail_after=None, checkpoint=True):
+    session = FakeVkSession(latency=0, rate_limit=0, fail_after=fail_after)
+    api = vk_utils.VkApiPool([session], rate=1000)
+    ckpt = checkpoint_path(GROUPS, N_TARGET, directory=str(tmp_path / 'checkpoints')) if checkpoint else None
+    collect_users(GROUPS, N_TARGET, records, api=api, seen=SeenIndex(str(tmp_path / 'seen')), checkpoint=ckpt)
+    return session.calls, ckpt
+
+
+def test_interrupted_collection_resumes_from_checkpoint(tmp_path):
+    baseline_calls, _ = collect(tmp_path / 'baseline', [], checkpoint=False)
+
+    before = []
+    with pytest.raises(QuotaExceeded):
+        collect(tmp_path, before, fail_after=5)
+    ckpt = checkpoint_path(GROUPS, N_TARGET, directory=str(tmp_path / 'checkpoints'))
+    state = load_checkpoint(ckpt)
+    assert state is not None
+    assert state['collected'] == [u['user_id'] for u in before]
+
+    after = []
+    resumed_calls, _ = collect(tmp_path, after)
+    assert load_checkpoint(ckpt) is None    # сбор завершён — чекпоинт удалён
+
+    ids = [u['user_id'] for u in before + after]
+    assert len(ids) == N_TARGET
+    assert len(set(ids)) == N_TARGET        # никого не собрали дважды
+    # продолжение не повторяет уже сделанную работу: сверх сбора без обрыва — не больше
+    # ответов, пришедших в момент обрыва (по одному на воркер), и недобранного раунда страниц
+    assert 5 + resumed_calls <= baseline_calls + SUB_WORKERS + 1
+
+    # следующий сбор с тем же индексом обработанных не возвращает уже собранных
+    again = []
+    collect(tmp_path, again, checkpoint=False)
+    assert not set(ids) & {u['user_id'] for u in again}
@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+
+import pytest
+
+from fs_utils import atomic_dir, atomic_write
+
+
+def test_atomic_write_keeps_old_file_on_error(tmp_path):
+    path = str(tmp_path / 'index.json')
+    with atomic_write(path) as f:
+        json.dump({'version': 1}, f)
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as f:
+            f.write('{"vers')
+            raise RuntimeError
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) == {'version': 1}
+    assert os.listdir(tmp_path) == ['index.json']
+
+
+def test_concurrent_writers_never_expose_partial_files(tmp_path):
+    path = str(tmp_path / 'state.json')
+    payloads = [{'writer': i, 'data': [i] * 10_000} for i in range(8)]
+
+    def write(payload):
+        for _ in range(20):
+            with atomic_write(path) as f:
+                json.dump(payload, f)
+
+    threads = [threading.Thread(target=write, args=(p,)) for p in payloads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) in payloads
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_atomic_dir_replaces_whole_directory(tmp_path):
+    path = str(tmp_path / 'artifact')
+    for version in ('old', 'new'):
+        with atomic_dir(path) as tmp:
+            with open(os.path.join(tmp, version), 'w') as f:
+                f.write(version)
+    assert os.listdir(path) == ['new']
+    assert os.listdir(tmp_path) == ['artifact']
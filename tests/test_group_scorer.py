@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from embeddings import GroupScorer, build_tfidf_matrix, build_user_profiles, load_embeddings
+
+DIM = 8
+GROUPS = [(1, 'бег марафон'), (2, 'клуб любителей кошек'), (3, 'шахматы турнир'), (4, 'рыбалка озеро')]
+
+
+@pytest.fixture
+def catalog():
+    groups_meta = pd.DataFrame({'group_id': [g for g, _ in GROUPS], 'name': [t for _, t in GROUPS],
+                                'status': [''] * len(GROUPS)})
+    groups_meta['text'] = groups_meta['name']
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta, min_df=1)
+    rng = np.random.default_rng(0)
+    # у группы 4 эмбеддинга нет: на неё можно сослаться, но очков она не даёт
+    embs = {gid: rng.standard_normal(DIM).astype(np.float32) for gid in (1, 2, 3)}
+    return groups_meta, vectorizer, tfidf_matrix, embs
+
+
+def as_store(embs, prefix):
+    ids = np.array(sorted(embs), dtype=np.int64)
+    np.save(prefix + '.emb.npy', np.vstack([embs[g] for g in ids]))
+    np.save(prefix + '.ids.npy', ids)
+    return load_embeddings(prefix)
+
+
+def cosine(vectors, prompt):
+    u = np.mean(vectors, axis=0)
+    return float(u @ prompt / (np.linalg.norm(u) * np.linalg.norm(prompt)))
+
+
+@pytest.mark.parametrize('storage', ['dict', 'store'])
+def test_score_users_matches_cosine_of_mean_embedding(catalog, tmp_path, storage):
+    groups_meta, vectorizer, tfidf_matrix, embs = catalog
+    emb_map = embs if storage == 'dict' else as_store(embs, str(tmp_path / 'groups'))
+    users = pd.DataFrame({'user_id': [10, 20, 30, 40], 'groups': [
+        # повторная подписка на группу учитывается дважды, как в среднем по списку
+        [{'id': 1, 'name': 'бег марафон'}, {'id': 1, 'name': 'бег марафон'}, {'id': 2, 'name': ''}],
+        # группы 100 нет среди эмбеддингов — по TF-IDF она совпадает с группой 2
+        [{'id': 3, 'name': 'шахматы турнир'}, {'id': 100, 'name': 'клуб любителей кошек'}],
+        # для группы 200 похожей нет — она пропускается
+        [{'id': 200, 'name': 'абырвалг'}, {'id': 1, 'name': 'бег марафон'}],
+        # ни одной группы с эмбеддингом — пользователя нет в профилях
+        [{'id': 200, 'name': 'абырвалг'}, {'id': 4, 'name': 'рыбалка озеро'}],
+    ]})
+    user_ids, indptr, group_ids, norms = build_user_profiles(
+        users, emb_map, groups_meta, vectorizer, tfidf_matrix, cache_path=str(tmp_path / 'nearest.json'))
+    assert user_ids.tolist() == [10, 20, 30]
+    assert group_ids[indptr[1]:indptr[2]].tolist() == [3, 2]
+
+    prompt = np.random.default_rng(1).standard_normal(DIM).astype(np.float32)
+    scorer = GroupScorer(emb_map, prompt)
+    sims = scorer.score_users(indptr, group_ids, norms)
+    expected = [cosine([embs[1], embs[1], embs[2]], prompt),
+                cosine([embs[3], embs[2]], prompt),
+                cosine([embs[1]], prompt)]
+    np.testing.assert_allclose(sims, expected, atol=1e-5)
+
+    # вклады групп (explain) в сумме дают similarity пользователя
+    contrib = scorer.explain(group_ids[indptr[0]:indptr[1]], norms[0], top=None)
+    assert sum(c for _, c in contrib) == pytest.approx(float(sims[0]), abs=1e-5)
+
+
+def test_unknown_groups_score_zero(catalog):
+    _, _, _, embs = catalog
+    scorer = GroupScorer(embs, np.ones(DIM, dtype=np.float32))
+    scores = scorer.group_scores([1, 4, 999])
+    assert scores[0] != 0
+    assert scores[1:].tolist() == [0.0, 0.0]
@@ -0,0 +1,14 @@
+from bench.import_time import HEAVY, measure_imports
+
+# Главная проверка — что torch, sentence_transformers, langchain_gigachat, vk_api
+# и прочие тяжёлые библиотеки не попадают в sys.modules на импорте. Время
+# зависит от машины, поэтому бюджет здесь с большим запасом (строгий —
+# в python -m bench.import_time --budget 1.0)
+IMPORT_BUDGET = 5.0
+
+
+def test_startup_imports_stay_light():
+    result = measure_imports(repeat=1)
+    assert {'torch', 'sentence_transformers', 'langchain_gigachat', 'vk_api'} <= set(HEAVY)
+    assert result['loaded'] == [], f"в sys.modules после импорта: {result['loaded']}"
+    assert result['seconds'] < IMPORT_BUDGET
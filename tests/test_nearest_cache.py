@@ -0,0 +1,57 @@
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+from embeddings import build_tfidf_matrix, flush_nearest_cache, load_embeddings, resolve_unknown_groups
+
+TEXTS = ['бег марафон', 'клуб любителей кошек', 'шахматы турнир', 'рыбалка озеро']
+
+
+def catalog():
+    groups_meta = pd.DataFrame({'group_id': [1, 2, 3, 4], 'text': TEXTS})
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta, min_df=1)
+    return groups_meta, vectorizer, tfidf_matrix
+
+
+def test_concurrent_batches_are_flushed_once_without_losing_entries(tmp_path):
+    groups_meta, vectorizer, tfidf_matrix = catalog()
+    cache_path = str(tmp_path / 'nearest.json')
+    # запись другого процесса, уже лежащая на диске, не должна потеряться
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump({'sim_threshold': 0.45, 'n_groups': 4, 'nearest': {'500': 4}}, f)
+
+    batches = [[{'id': 100 + i, 'name': TEXTS[i % 4]}, {'id': 200 + i, 'name': 'абырвалг'}] for i in range(8)]
+    threads = [threading.Thread(target=resolve_unknown_groups,
+                                args=(batch, {}, groups_meta, vectorizer, tfidf_matrix, 0.45, cache_path))
+               for batch in batches]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(cache_path, encoding='utf-8') as f:
+        assert json.load(f)['nearest'] == {'500': 4}   # до flush файл не перезаписывается
+
+    flush_nearest_cache(cache_path)
+    with open(cache_path, encoding='utf-8') as f:
+        nearest = json.load(f)['nearest']
+    assert nearest.pop('500') == 4
+    assert nearest == {**{str(100 + i): i % 4 + 1 for i in range(8)}, **{str(200 + i): None for i in range(8)}}
+
+    # уже найденные группы берутся из памяти, без нового TF-IDF
+    resolved = resolve_unknown_groups([{'id': 101, 'name': ''}], {}, groups_meta, vectorizer, tfidf_matrix,
+                                      0.45, cache_path)
+    assert resolved == {101: 2}
+
+
+def test_store_and_dict_emb_maps_skip_the_same_groups(tmp_path):
+    groups_meta, vectorizer, tfidf_matrix = catalog()
+    emb_map = {1: np.ones(4, dtype=np.float32), 3: np.zeros(4, dtype=np.float32)}
+    prefix = str(tmp_path / 'groups')
+    np.save(prefix + '.ids.npy', np.array([1, 3], dtype=np.int64))
+    np.save(prefix + '.emb.npy', np.vstack([emb_map[1], emb_map[3]]))
+    groups = [{'id': 1}, {'id': 3}, {'id': 100, 'name': TEXTS[1]}, {'id': 100}, {'id': None}]
+    expected = {100: 2}
+    assert resolve_unknown_groups(groups, emb_map, groups_meta, vectorizer, tfidf_matrix) == expected
+    assert resolve_unknown_groups(groups, load_embeddings(prefix), groups_meta, vectorizer, tfidf_matrix) == expected
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+import embeddings
+from embeddings import build_tfidf_matrix
+from pipeline import build_user_index, rank_stored_users
+from user_store import open_store, upsert_users
+
+DIM = 8
+
+
+def test_rank_stored_users_filters_and_ranks_by_index(tmp_path, monkeypatch):
+    groups_meta = pd.DataFrame({'group_id': [1, 2, 3], 'text': ['бег', 'кошки', 'шахматы']})
+    vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta, min_df=1)
+    rng = np.random.default_rng(0)
+    emb_map = {gid: rng.standard_normal(DIM).astype(np.float32) for gid in (1, 2, 3)}
+    prompt = rng.standard_normal(DIM).astype(np.float32)
+    monkeypatch.setattr(embeddings, 'get_prompt_embedding', lambda text: prompt)
+    monkeypatch.chdir(tmp_path)
+
+    users = [{'user_id': uid, 'bdate': '1.1.1990', 'sex': sex, 'city': city, 'country': 'Россия',
+              'groups': [{'id': g, 'name': '', 'status': ''} for g in groups]}
+             for uid, sex, city, groups in [(10, 1, 'Казань', [1]), (11, 1, 'Казань', [2, 3]),
+                                            (12, 2, 'Казань', [2]), (13, 1, 'Москва', [3]),
+                                            (14, 1, 'Казань', [])]]
+    conn = open_store('users.db')
+    upsert_users(conn, users)
+    conn.close()
+
+    index = build_user_index((groups_meta, vectorizer, tfidf_matrix, emb_map), chunksize=2)
+    assert sorted(index.user_ids.tolist()) == [10, 11, 12, 13]   # без групп — не в индексе
+
+    def cosine(gids):
+        u = np.mean([emb_map[g] for g in gids], axis=0)
+        return float(u @ prompt / np.linalg.norm(u) / np.linalg.norm(prompt))
+
+    top = rank_stored_users('женщины казань', index, top_k=5)
+    expected = sorted([(cosine([1]), 10), (cosine([2, 3]), 11)], reverse=True)
+    assert top['user_id'].tolist() == [uid for _, uid in expected]
+    np.testing.assert_allclose(top['similarity'], [sim for sim, _ in expected], rtol=1e-5)
+    assert set(top['city']) == {'Казань'} and set(top['gender']) == {'Женский'}
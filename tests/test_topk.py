@@ -0,0 +1,25 @@
+import numpy as np
+
+from pipeline import TopK
+
+
+def test_batches_keep_global_top_k_and_explain_only_winners():
+    rng = np.random.default_rng(0)
+    user_ids = rng.permutation(10_000).astype(np.int64)
+    sims = rng.standard_normal(len(user_ids)).astype(np.float32)
+    explained = []
+    top = TopK(5, explain=lambda groups, norm: explained.append(int(groups[0])) or [(int(groups[0]), norm)])
+    # пакеты пересекаются: пользователь может прийти и из хранилища, и из свежего сбора
+    for start in range(0, len(user_ids), 1000):
+        batch = slice(max(start - 100, 0), start + 1000)
+        ids, scores = user_ids[batch], sims[batch]
+        rows = top.candidates(ids, scores)
+        assert len(rows) <= 5
+        top.push(scores[rows], [{'user_id': int(ids[i]), 'groups': ids[i:i + 1], 'norm': 1.0} for i in rows])
+
+    frame = top.frame()
+    best = np.argsort(-sims)[:5]
+    assert frame['user_id'].tolist() == user_ids[best].tolist()
+    np.testing.assert_allclose(frame['similarity'], sims[best])
+    assert sorted(explained) == sorted(user_ids[best].tolist())
+    assert frame['top_groups'].tolist() == [[(int(u), 1.0)] for u in user_ids[best]]
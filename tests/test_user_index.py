@@ -0,0 +1,39 @@
+import numpy as np
+
+from user_index import UserIndex, write_index
+
+
+def blocks(user_ids, embs, size):
+    return ((user_ids[i:i + size], embs[i:i + size]) for i in range(0, len(user_ids), size))
+
+
+def test_streaming_build_matches_in_memory_quantization(tmp_path):
+    rng = np.random.default_rng(0)
+    user_ids = np.arange(1000, 3000, dtype=np.int64)
+    embs = rng.standard_normal((len(user_ids), 32)).astype(np.float32)
+
+    # capacity с запасом: в индексе остаются только записанные строки
+    index = write_index(str(tmp_path / 'index'), blocks(user_ids, embs, 300), capacity=2500)
+    expected = UserIndex(user_ids, embs).quantize()
+    assert len(index) == len(user_ids) and index.codes.shape == expected.codes.shape
+    np.testing.assert_array_equal(index.codes, expected.codes)
+    np.testing.assert_allclose(index.scales, expected.scales)
+
+    exact = UserIndex(user_ids, embs)
+    for prompt in rng.standard_normal((20, 32)).astype(np.float32):
+        rows, sims = index.search(prompt, top_k=5)
+        exact_rows, exact_sims = exact.search(prompt, top_k=5)
+        assert rows.tolist() == exact_rows.tolist()
+        np.testing.assert_allclose(sims, exact_sims, rtol=1e-5)
+
+
+def test_rebuild_replaces_index_and_respects_capacity(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / 'index')
+    old = write_index(path, blocks(np.arange(10), rng.standard_normal((10, 8)), 4), capacity=10)
+    new = write_index(path, blocks(np.arange(100, 130), rng.standard_normal((30, 8)), 7), capacity=20)
+    assert new.user_ids.tolist() == list(range(100, 120))
+    assert UserIndex.load(path).user_ids.tolist() == list(range(100, 120))
+    # открытый раньше индекс продолжает читать свои файлы
+    assert old.search(np.ones(8), top_k=3)[0].shape == (3,)
+    assert not [p for p in tmp_path.iterdir() if p.name != 'index']
@@ -0,0 +1,20 @@
+import time
+
+from vk_cache import VkResponseCache
+
+
+def test_hits_are_written_in_batches_and_drive_lru_eviction(tmp_path):
+    cache = VkResponseCache(str(tmp_path / 'cache.db'))
+    for uid in (1, 2):
+        cache.put('users.getSubscriptions', {'user_id': uid}, {'items': [uid] * 100})
+        time.sleep(0.01)
+    cache.max_bytes = cache.total_bytes   # третья запись вытеснит одну из первых двух
+
+    changes = cache.conn.total_changes
+    assert cache.get('users.getSubscriptions', {'user_id': 1}) == {'items': [1] * 100}
+    assert cache.conn.total_changes == changes   # попадание не пишет в базу
+
+    cache.put('users.getSubscriptions', {'user_id': 3}, {'items': [3] * 100})
+    assert cache.get('users.getSubscriptions', {'user_id': 1}) is not None
+    assert cache.get('users.getSubscriptions', {'user_id': 2}) is None
+    assert cache.stats()['hits'] == 2
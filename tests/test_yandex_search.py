@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from bench.fake_yandex import FakeYandexServer
+from yandex_search import YandexSearchError, fetch_page, parse_group_id, parse_urls
+
+
+@pytest.mark.parametrize('url, gid', [
+    ('https://vk.com/club123', 123),
+    ('https://vk.com/public45/', 45),
+    ('http://m.vk.com/event678?w=wall', 678),
+    ('https://vk.com/group_name_5', None),
+    ('https://vk.com/club12/wall', None),
+    ('https://vk.com/id99', None),
+    (None, None),
+])
+def test_parse_group_id(url, gid):
+    assert parse_group_id(url) == gid
+
+
+def test_yandex_errors_are_raised_and_not_cached(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    with FakeYandexServer(error_code=32) as server:
+        with pytest.raises(YandexSearchError) as exc:
+            fetch_page('бег', url=server.url, cache_dir=cache_dir)
+        assert exc.value.code == '32'
+        with pytest.raises(YandexSearchError):
+            fetch_page('бег', url=server.url, cache_dir=cache_dir)
+        assert server.requests == 2
+    assert not os.path.exists(cache_dir) or os.listdir(cache_dir) == []
+
+
+def test_no_results_answer_is_cached(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    with FakeYandexServer(error_code=15) as server:
+        assert parse_urls(fetch_page('бег', url=server.url, cache_dir=cache_dir)) == []
+        assert parse_urls(fetch_page('бег', url=server.url, cache_dir=cache_dir)) == []
+        assert server.requests == 1
@@ -0,0 +1,162 @@
+"""
+Кэш TF-IDF по каталогу групп. Словарь, idf, CSR-матрица и group_id строк
+сохраняются в каталог артефактов и при следующем запуске открываются через
+memmap — без чтения CSV и без fit. Ключ кэша — SHA-1 содержимого CSV
+(плюс min_df); чтобы не хэшировать CSV на каждом старте, сначала
+сверяются размер и mtime файла.
+
+Если CSV изменился только добавлением групп и новых слов немного,
+новые строки дописываются к матрице с прежними словарём и idf; иначе
+(удалены/изменены группы, много новых слов) TF-IDF строится заново.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from embeddings import load_group_metadata, build_tfidf_matrix
+from fs_utils import atomic_dir
+from tracing import span, count
+
+TFIDF_CACHE_DIR = 'tfidf_cache'
+MAX_NEW_TERMS = 0.05    # доля новых слов (от словаря), при которой ещё дописываем без перестройки
+MAX_NEW_ROWS = 0.2      # доля новых групп (от каталога), при которой ещё дописываем без перестройки
+_ARRAYS = ('idf', 'data', 'indices', 'indptr', 'group_ids', 'text_hash')
+
+
+def file_sha1(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while block := f.read(chunk):
+            h.update(block)
+    return h.hexdigest()
+
+
+def text_hashes(texts):
+    """64-битные хэши текстов групп — по ним находятся изменённые строки CSV."""
+    return np.array([int.from_bytes(hashlib.blake2b(t.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+                     for t in texts], dtype=np.int64)
+
+
+def _make_vectorizer(vocabulary, idf, min_df):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(vocabulary=vocabulary, min_df=min_df)
+    vectorizer.idf_ = idf
+    return vectorizer
+
+
+def _csr(arrays, shape):
+    import scipy.sparse as sp
+
+    return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
+
+def load_artifact(cache_dir=TFIDF_CACHE_DIR):
+    """(manifest, vectorizer, tfidf_matrix, arrays) из каталога кэша или None."""
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in _ARRAYS}
+        with open(os.path.join(cache_dir, 'vocab.txt'), 'r', encoding='utf-8') as f:
+            terms = f.read().split('\n')
+    except (FileNotFoundError, json.JSONDecodeError, ValueError):
+        return None
+    vocabulary = dict(zip(terms, range(len(terms)))) if manifest['n_terms'] else {}
+    vectorizer = _make_vectorizer(vocabulary, np.asarray(arrays['idf']), manifest['min_df'])
+    return manifest, vectorizer, _csr(arrays, tuple(manifest['shape'])), arrays
+
+
+def save_artifact(cache_dir, manifest, vectorizer, tfidf_matrix, group_ids, hashes):
+    """Пишет артефакт во временный каталог и подменяет им старый целиком."""
+    terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+    tfidf_matrix = tfidf_matrix.tocsr()
+    arrays = {'idf': vectorizer.idf_, 'data': tfidf_matrix.data, 'indices': tfidf_matrix.indices,
+              'indptr': tfidf_matrix.indptr, 'group_ids': group_ids, 'text_hash': hashes}
+    manifest = dict(manifest, n_terms=len(terms), shape=list(tfidf_matrix.shape))
+    with atomic_dir(cache_dir) as tmp:
+        with open(os.path.join(tmp, 'vocab.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(terms))
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+        with open(os.path.join(tmp, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+def _csv_stat(csv_path):
+    st = os.stat(csv_path)
+    return {'csv_size': st.st_size, 'csv_mtime_ns': st.st_mtime_ns}
+
+
+def _append(cached, groups_meta, hashes):
+    """
+    Дописывает к закэшированной матрице новые группы с прежними словарём и idf.
+    None — нужна полная перестройка (группы удалены/изменены или слишком много нового).
+    """
+    manifest, vectorizer, tfidf_matrix, arrays = cached
+    old_ids = np.asarray(arrays['group_ids'])
+    ids = groups_meta['group_id'].to_numpy(dtype=np.int64)
+    index = pd.Index(ids)
+    if not index.is_unique:
+        return None
+    pos = index.get_indexer(old_ids)
+    if (pos < 0).any() or (hashes[pos] != np.asarray(arrays['text_hash'])).any():
+        return None
+    is_new = np.ones(len(ids), dtype=bool)
+    is_new[pos] = False
+    if not is_new.any() or is_new.sum() > MAX_NEW_ROWS * len(old_ids):
+        return None
+    new_texts = groups_meta['text'].to_numpy()[is_new]
+
+    analyzer = vectorizer.build_analyzer()
+    new_terms = {t for text in new_texts for t in analyzer(text)} - vectorizer.vocabulary_.keys()
+    if len(new_terms) > MAX_NEW_TERMS * len(vectorizer.vocabulary_):
+        return None
+
+    import scipy.sparse as sp
+
+    appended = sp.vstack([tfidf_matrix, vectorizer.transform(new_texts)], format='csr')
+    return (vectorizer, appended, np.concatenate([old_ids, ids[is_new]]),
+            np.concatenate([np.asarray(arrays['text_hash']), hashes[is_new]]))
+
+
+def load_tfidf(csv_path, cache_dir=TFIDF_CACHE_DIR, min_df=2):
+    """
+    (groups_meta, vectorizer, tfidf_matrix) для каталога групп. groups_meta
+    содержит только group_id строк матрицы — остальным стадиям больше не нужно.
+    """
+    cached = load_artifact(cache_dir)
+    stat = _csv_stat(csv_path)
+    if cached and cached[0]['min_df'] == min_df:
+        manifest = cached[0]
+        fresh = all(manifest.get(k) == v for k, v in stat.items())
+        if not fresh and manifest.get('csv_sha1') == file_sha1(csv_path):
+            # содержимое то же (файл просто перезаписан) — обновим только stat
+            manifest.update(stat)
+            with open(os.path.join(cache_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=1)
+            fresh = True
+        if fresh:
+            count('tfidf.cache_hit')
+            _, vectorizer, tfidf_matrix, arrays = cached
+            return pd.DataFrame({'group_id': np.asarray(arrays['group_ids'])}), vectorizer, tfidf_matrix
+
+    count('tfidf.cache_miss')
+    groups_meta = load_group_metadata(csv_path)
+    hashes = text_hashes(groups_meta['text'])
+    manifest = {'csv_sha1': file_sha1(csv_path), 'min_df': min_df, **stat}
+
+    result = None
+    if cached and cached[0]['min_df'] == min_df:
+        with span('tfidf.append'):
+            result = _append(cached, groups_meta, hashes)
+    if result is not None:
+        count('tfidf.appended')
+        vectorizer, tfidf_matrix, group_ids, hashes = result
+    else:
+        vectorizer, tfidf_matrix = build_tfidf_matrix(groups_meta, min_df=min_df)
+        group_ids = groups_meta['group_id'].to_numpy(dtype=np.int64)
+    save_artifact(cache_dir, manifest, vectorizer, tfidf_matrix, group_ids, hashes)
+    return pd.DataFrame({'group_id': group_ids}), vectorizer, tfidf_matrix.tocsr()
@@ -0,0 +1,225 @@
+"""
+Инструментация пайплайна: спаны стадий с таймингами, счётчики (вызовы API,
+ошибки, попадания в кэш, TF-IDF-фолбэки, отсев фильтрами), снимки памяти
+и необязательный профилировщик (cProfile или pyinstrument).
+
+    with span('vk.getMembers', group_id=gid):
+        ...
+    count('vk.calls')
+    export_trace('trace.json'); print(summary_table())
+
+Трейс сохраняется в формате Chrome Trace Event (открывается в chrome://tracing
+или ui.perfetto.dev), сводка — текстовой таблицей.
+
+Сводка по стадиям и счётчики — агрегаты фиксированного размера и ведутся всегда.
+Отдельные спаны для трейса записываются только по запросу (OSINT_TRACE или
+OSINT_PROFILE в окружении, либо record_spans()) и не больше MAX_SPANS последних:
+в долгоживущем процессе (server.py) память не растёт с каждым запросом.
+"""
+import contextvars
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('OSINT_TRACE_DISABLED') != '1'
+RECORD_SPANS = bool(os.environ.get('OSINT_TRACE') or os.environ.get('OSINT_PROFILE'))
+MAX_SPANS = 200_000
+MAX_SNAPSHOTS = 1000
+
+_lock = threading.Lock()
+_spans = deque(maxlen=MAX_SPANS)        # завершённые спаны (только при RECORD_SPANS)
+_agg = {}                               # name → агрегаты для summary()
+_counters = Counter()
+_memory = deque(maxlen=MAX_SNAPSHOTS)   # снимки памяти
+_parent = contextvars.ContextVar('span_parent', default=None)
+_next_id = 0
+_t0 = time.perf_counter()
+_profiler = None
+_profiler_kind = None
+
+
+def record_spans(enabled=True):
+    """Включает/выключает запись отдельных спанов (нужна только для export_trace)."""
+    global RECORD_SPANS
+    RECORD_SPANS = enabled
+
+
+def _new_id():
+    global _next_id
+    with _lock:
+        _next_id += 1
+        return _next_id
+
+
+@contextmanager
+def span(name, **attrs):
+    """Замер стадии; вложенные спаны запоминают родителя (в т.ч. внутри asyncio-задач)."""
+    if not ENABLED:
+        yield
+        return
+    span_id = _new_id()
+    token = _parent.set(span_id)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _parent.reset(token)
+        with _lock:
+            a = _agg.setdefault(name, {'count': 0, 'total_s': 0.0, 'max_ms': 0.0, 'errors': 0})
+            a['count'] += 1
+            a['total_s'] += duration
+            a['max_ms'] = max(a['max_ms'], duration * 1000)
+            a['errors'] += error is not None
+        if RECORD_SPANS:
+            record = {'id': span_id, 'parent': _parent.get(), 'name': name, 'start': start - _t0,
+                      'duration': duration, 'thread': threading.get_ident(), 'attrs': attrs}
+            if error:
+                record['error'] = error
+            with _lock:
+                _spans.append(record)
+
+
+def traced(name=None):
+    """Декоратор: оборачивает функцию в span (по умолчанию — module.function)."""
+    def decorator(fn):
+        span_name = name or f"{fn.__module__}.{fn.__name__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    if ENABLED and n:
+        with _lock:
+            _counters[name] += n
+
+
+def _rss_mb():
+    """Текущий RSS (Linux, /proc) или пиковый, если /proc недоступен."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (2 ** 20 if sys.platform == 'darwin' else 1024)
+
+
+def memory_snapshot(label):
+    """Запоминает текущий и пиковый RSS процесса."""
+    if not ENABLED:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 1024)
+    with _lock:
+        _memory.append({'label': label, 'time': time.perf_counter() - _t0,
+                        'rss_mb': round(_rss_mb(), 1), 'peak_rss_mb': round(peak, 1)})
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    global _t0
+    with _lock:
+        _spans.clear()
+        _agg.clear()
+        _counters.clear()
+        _memory.clear()
+        _t0 = time.perf_counter()
+
+
+def start_profile(kind='cprofile'):
+    """Запускает профилировщик: 'cprofile' (stdlib) или 'pyinstrument' (если установлен)."""
+    global _profiler, _profiler_kind
+    if kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument не установлен — используем cProfile")
+            kind = 'cprofile'
+        else:
+            _profiler = Profiler(async_mode='enabled')
+    if kind == 'cprofile':
+        import cProfile
+        _profiler = cProfile.Profile()
+    _profiler_kind = kind
+    _profiler.start() if kind == 'pyinstrument' else _profiler.enable()
+
+
+def stop_profile(path):
+    """Останавливает профилировщик и сохраняет результат (.prof для cProfile, .html для pyinstrument)."""
+    global _profiler
+    if _profiler is None:
+        return None
+    if _profiler_kind == 'pyinstrument':
+        _profiler.stop()
+        path = os.path.splitext(path)[0] + '.html'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(_profiler.output_html())
+    else:
+        _profiler.disable()
+        path = os.path.splitext(path)[0] + '.prof'
+        _profiler.dump_stats(path)
+    _profiler = None
+    return path
+
+
+def export_trace(path):
+    """Сохраняет спаны, счётчики и снимки памяти в JSON (Chrome Trace Event)."""
+    with _lock:
+        spans, cnt, memory = list(_spans), dict(_counters), list(_memory)
+    events = [{'name': s['name'], 'ph': 'X', 'ts': s['start'] * 1e6, 'dur': s['duration'] * 1e6,
+               'pid': os.getpid(), 'tid': s['thread'],
+               'args': {**{k: str(v) for k, v in s['attrs'].items()}, **({'error': s['error']} if 'error' in s else {})}}
+              for s in spans]
+    events += [{'name': 'rss_mb', 'ph': 'C', 'ts': m['time'] * 1e6, 'pid': os.getpid(),
+                'args': {'rss': m['rss_mb']}} for m in memory]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'counters': cnt, 'memory': memory, 'spans': spans},
+                  f, ensure_ascii=False)
+
+
+def summary():
+    """Агрегаты по спанам: {name: {count, total_s, mean_ms, max_ms}}."""
+    with _lock:
+        agg = {name: dict(a) for name, a in _agg.items()}
+    for a in agg.values():
+        a['mean_ms'] = a['total_s'] * 1000 / a['count']
+    return agg
+
+
+def summary_table():
+    """Текстовая сводка прогона: стадии по убыванию суммарного времени, счётчики, память."""
+    lines = [f"{'стадия':<40} {'вызовов':>8} {'всего, с':>10} {'среднее, мс':>12} {'макс, мс':>10} {'ошибок':>7}"]
+    for name, a in sorted(summary().items(), key=lambda kv: -kv[1]['total_s']):
+        lines.append(f"{name:<40} {a['count']:>8} {a['total_s']:>10.3f} {a['mean_ms']:>12.1f} "
+                     f"{a['max_ms']:>10.1f} {a['errors']:>7}")
+    cnt = counters()
+    if cnt:
+        lines.append('')
+        lines.append(f"{'счётчик':<40} {'значение':>8}")
+        lines += [f"{k:<40} {v:>8}" for k, v in sorted(cnt.items())]
+    with _lock:
+        memory = list(_memory)
+    if memory:
+        lines.append('')
+        lines.append(f"{'память':<40} {'RSS, МБ':>8} {'пик, МБ':>10}")
+        lines += [f"{m['label']:<40} {m['rss_mb']:>8} {m['peak_rss_mb']:>10}" for m in memory]
+    return '\n'.join(lines)
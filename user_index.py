@@ -0,0 +1,253 @@
+import os
+import numpy as np
+
+from fs_utils import atomic_dir
+
+SCAN_CHUNK = 65536      # строк на блок при проходе по матрице
+CODES_CHUNK = 256       # строк int8-кодов на блок: перевод во float32 остаётся в кэше процессора
+RERANK_FACTOR = 20      # кандидатов на точный пересчёт: top_k * RERANK_FACTOR (не меньше MIN_CANDIDATES)
+MIN_CANDIDATES = 100
+
+
+def _normalize_rows(matrix):
+    """L2-нормировка строк (нулевые строки остаются нулевыми)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, top_k):
+    """Индексы top_k наибольших значений по убыванию (argpartition + сортировка k)."""
+    k = min(top_k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind='stable')]
+
+
+def quantize_rows(matrix, chunk=SCAN_CHUNK):
+    """
+    Симметричное int8-квантование по строкам: row ≈ codes * scale,
+    scale = max|row| / 127. Возвращает (codes int8, scales float32).
+    """
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), chunk):
+        block = np.asarray(matrix[start:start + chunk], dtype=np.float32)
+        scale = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127
+        codes[start:start + chunk] = np.rint(block / scale[:, None])
+        scales[start:start + chunk] = scale
+    return codes, scales
+
+
+def write_index(path, chunks, capacity):
+    """
+    Потоковая запись квантованного индекса в каталог path (формат UserIndex.save).
+    chunks — итерация пар (user_ids, emb_block); в памяти — только текущий блок:
+    он нормируется, квантуется и сразу пишется в memmap-файлы emb.npy (float32,
+    для пересчёта кандидатов), codes.npy (int8) и scales.npy. capacity — верхняя
+    граница числа строк (файлы выделяются заранее, лишние строки сверх неё
+    отбрасываются). Индекс собирается во временном каталоге и подменяет path
+    целиком. Возвращает UserIndex.load(path).
+    """
+    ids, n, files = [], 0, None
+    with atomic_dir(path) as tmp:
+        for user_ids, block in chunks:
+            block = _normalize_rows(block)[:capacity - n]
+            if not len(block):
+                continue
+            if files is None:
+                dim = block.shape[1]
+                files = (
+                    np.lib.format.open_memmap(os.path.join(tmp, 'emb.npy'), mode='w+', dtype=np.float32,
+                                              shape=(capacity, dim)),
+                    np.lib.format.open_memmap(os.path.join(tmp, 'codes.npy'), mode='w+', dtype=np.int8,
+                                              shape=(capacity, dim)),
+                    np.lib.format.open_memmap(os.path.join(tmp, 'scales.npy'), mode='w+', dtype=np.float32,
+                                              shape=(capacity,)),
+                )
+            matrix, codes, scales = files
+            matrix[n:n + len(block)] = block
+            codes[n:n + len(block)], scales[n:n + len(block)] = quantize_rows(block)
+            ids.append(np.asarray(user_ids[:len(block)], dtype=np.int64))
+            n += len(block)
+        if files is None:
+            np.save(os.path.join(tmp, 'emb.npy'), np.empty((0, 0), dtype=np.float32))
+        else:
+            for f in files:
+                f.flush()
+        # строк может оказаться меньше capacity: load берёт первые len(ids)
+        np.save(os.path.join(tmp, 'ids.npy'), np.concatenate(ids) if ids else np.empty(0, dtype=np.int64))
+    # уже открытые индексы (memmap) продолжают работать со старыми файлами
+    return UserIndex.load(path)
+
+
+class UserIndex:
+    """
+    Индекс эмбеддингов пользователей для поиска по cosine-similarity.
+    Матрица нормируется один раз при построении, поэтому сходство — это
+    просто скалярное произведение. Поддерживает:
+      - точный top-k через argpartition;
+      - приближённый режим IVF (k-means разбиение, параметр n_probe);
+      - предварительную маску строк (фильтры по возрасту/полу/городу);
+      - int8-квантование (quantize): первый проход top-k по кодам
+        (4× меньше памяти), затем точный float32-пересчёт кандидатов;
+      - сохранение/загрузку с диска (матрица и коды открываются через memmap).
+    """
+
+    def __init__(self, user_ids, emb_matrix, normalized=False):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.matrix = emb_matrix if normalized else _normalize_rows(emb_matrix)
+        self.centroids = None
+        self.list_order = None
+        self.list_offsets = None
+        self.codes = None
+        self.scales = None
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def _assign(self, centroids, chunk=65536):
+        """Номер ближайшего центроида для каждой строки (по чанкам, чтобы не раздувать память)."""
+        labels = np.empty(len(self.matrix), dtype=np.int32)
+        for start in range(0, len(self.matrix), chunk):
+            block = np.asarray(self.matrix[start:start + chunk])
+            labels[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+        return labels
+
+    def build_ivf(self, n_lists=None, n_iter=10, sample_size=100_000, seed=0):
+        """
+        Строит IVF-разбиение сферическим k-means.
+        Центроиды обучаются на случайной подвыборке, затем все строки
+        раскладываются по спискам.
+        """
+        n = len(self.matrix)
+        if n == 0:
+            return self
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+        sample = np.asarray(self.matrix[sample_rows])
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            empty = counts == 0
+            if empty.any():
+                # пустые кластеры пересеиваем случайными точками
+                sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = _normalize_rows(sums)
+
+        labels = self._assign(centroids)
+        self.centroids = centroids
+        self.list_order = np.argsort(labels, kind='stable').astype(np.int64)
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(labels, minlength=n_lists)))
+        ).astype(np.int64)
+        return self
+
+    def quantize(self):
+        """Строит int8-коды матрицы: дальше первый проход поиска идёт по ним."""
+        self.codes, self.scales = quantize_rows(self.matrix)
+        return self
+
+    def _scores(self, query, rows=None):
+        """
+        Сходство строк rows (None — всех) с query блоками: по int8-кодам,
+        если индекс квантован, иначе по float32-матрице.
+        """
+        n = len(self) if rows is None else len(rows)
+        chunk = SCAN_CHUNK if self.codes is None else CODES_CHUNK
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk):
+            part = slice(start, start + chunk) if rows is None else rows[start:start + chunk]
+            if self.codes is None:
+                scores[start:start + chunk] = np.asarray(self.matrix[part]) @ query
+            else:
+                block = np.asarray(self.codes[part], dtype=np.float32)
+                scores[start:start + chunk] = (block @ query) * self.scales[part]
+        return scores
+
+    def _candidates(self, query, n_probe):
+        """Строки из n_probe ближайших IVF-списков."""
+        probe = _top_k(self.centroids @ query, n_probe)
+        return np.concatenate(
+            [self.list_order[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probe]
+        )
+
+    def search(self, query_emb, top_k=10, mask=None, n_probe=None, n_candidates=None):
+        """
+        Возвращает (rows, scores) — индексы строк индекса и cosine-similarity,
+        по убыванию сходства. mask — булев массив длины len(index): строки с
+        False не рассматриваются. n_probe включает приближённый IVF-режим
+        (нужен build_ivf); None — точный поиск. У квантованного индекса
+        n_candidates лучших по int8-кодам пересчитываются точно по float32
+        (по умолчанию max(top_k * RERANK_FACTOR, MIN_CANDIDATES)).
+        """
+        query = np.asarray(query_emb, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        if n_probe is not None and self.centroids is not None:
+            rows = self._candidates(query, n_probe)
+            if mask is not None:
+                rows = rows[mask[rows]]
+        elif mask is not None:
+            rows = np.flatnonzero(mask)
+        else:
+            rows = None
+
+        if rows is not None:
+            if len(rows) == 0:
+                return rows.astype(np.int64), np.empty(0, dtype=np.float32)
+            # сортированные строки — последовательное чтение memmap
+            rows = np.sort(rows)
+        scores = self._scores(query, rows)
+        if self.codes is None:
+            best = _top_k(scores, top_k)
+            return (best if rows is None else rows[best]), scores[best]
+
+        n_candidates = n_candidates or max(top_k * RERANK_FACTOR, MIN_CANDIDATES)
+        candidates = _top_k(scores, n_candidates)
+        candidates = np.sort(candidates if rows is None else rows[candidates])
+        exact = np.asarray(self.matrix[candidates]) @ query
+        best = _top_k(exact, top_k)
+        return candidates[best], exact[best]
+
+    def save(self, path):
+        """Сохраняет индекс в каталог path."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'ids.npy'), self.user_ids)
+        np.save(os.path.join(path, 'emb.npy'), np.asarray(self.matrix, dtype=np.float32))
+        if self.codes is not None:
+            np.save(os.path.join(path, 'codes.npy'), self.codes)
+            np.save(os.path.join(path, 'scales.npy'), self.scales)
+        if self.centroids is not None:
+            self.save_ivf(path)
+
+    def save_ivf(self, path):
+        """Сохраняет только IVF-разбиение (индекс уже на диске, например из write_index)."""
+        np.savez(os.path.join(path, 'ivf.npz'), centroids=self.centroids,
+                 list_order=self.list_order, list_offsets=self.list_offsets)
+
+    @classmethod
+    def load(cls, path):
+        """Загружает индекс из каталога path; матрица открывается через memmap."""
+        user_ids = np.load(os.path.join(path, 'ids.npy'))
+        n = len(user_ids)
+        # у индекса из write_index файлы выделены с запасом — берём первые n строк
+        index = cls(user_ids, np.load(os.path.join(path, 'emb.npy'), mmap_mode='r')[:n], normalized=True)
+        if os.path.exists(os.path.join(path, 'codes.npy')):
+            # float32-матрица нужна только для пересчёта кандидатов и с диска почти не читается
+            index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')[:n]
+            index.scales = np.array(np.load(os.path.join(path, 'scales.npy'), mmap_mode='r')[:n])
+        ivf_path = os.path.join(path, 'ivf.npz')
+        if os.path.exists(ivf_path):
+            ivf = np.load(ivf_path)
+            index.centroids = ivf['centroids']
+            index.list_order = ivf['list_order']
+            index.list_offsets = ivf['list_offsets']
+        return index
@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+from datetime import date
+
+import pandas as pd
+
+# коды пола VK ↔ значения, с которыми работает filtering.py
+SEX_CODES = {'Женский': 1, 'Мужской': 2}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id    INTEGER PRIMARY KEY,
+    bdate      TEXT,
+    birth_date TEXT,      -- ISO YYYY-MM-DD, только если в bdate есть год
+    sex        INTEGER,
+    city       TEXT,
+    country    TEXT,
+    groups     TEXT,      -- JSON-список {id, name, status}
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    emb_groups TEXT,      -- профиль для GroupScorer: JSON-список gid из таблицы эмбеддингов
+    emb_norm   REAL       -- и норма эмбеддинга пользователя (embeddings.build_user_profiles)
+);
+CREATE INDEX IF NOT EXISTS users_sex ON users(sex);
+CREATE INDEX IF NOT EXISTS users_city ON users(city);
+CREATE INDEX IF NOT EXISTS users_birth_date ON users(birth_date);
+'''
+
+UPSERT = '''
+INSERT INTO users (user_id, bdate, birth_date, sex, city, country, groups, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT(user_id) DO UPDATE SET
+    bdate = excluded.bdate,
+    birth_date = excluded.birth_date,
+    sex = excluded.sex,
+    city = excluded.city,
+    country = excluded.country,
+    groups = excluded.groups,
+    updated_at = excluded.updated_at,
+    -- профиль остаётся действительным, только пока не изменились подписки
+    emb_groups = CASE WHEN users.groups = excluded.groups THEN users.emb_groups END,
+    emb_norm = CASE WHEN users.groups = excluded.groups THEN users.emb_norm END
+'''
+
+# колонки, добавленные после первой версии схемы (для уже созданных хранилищ)
+ADDED_COLUMNS = {'emb_groups': 'TEXT', 'emb_norm': 'REAL'}
+
+
+def _birth_date(bdate):
+    """'D.M.YYYY' → 'YYYY-MM-DD'; без года (или при ошибке) — None."""
+    if not bdate:
+        return None
+    parts = str(bdate).split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        return date(int(parts[2]), int(parts[1]), int(parts[0])).isoformat()
+    except ValueError:
+        return None
+
+
+def _years_ago(today, years):
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:  # 29 февраля
+        return today.replace(year=today.year - years, day=28)
+
+
+def open_store(path='users.db'):
+    """Открывает (и при необходимости создаёт) SQLite-хранилище пользователей."""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.executescript(SCHEMA)
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    with conn:
+        for column, sql_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f'ALTER TABLE users ADD COLUMN {column} {sql_type}')
+    return conn
+
+
+def upsert_users(conn, users):
+    """
+    Добавляет/обновляет пользователей (ключ — user_id).
+    users — список словарей в формате vk_utils.make_user_record.
+    """
+    rows = [
+        (u['user_id'], u.get('bdate'), _birth_date(u.get('bdate')), u.get('sex'),
+         u.get('city'), u.get('country'), json.dumps(u.get('groups') or [], ensure_ascii=False))
+        for u in users
+    ]
+    with conn:
+        conn.executemany(UPSERT, rows)
+    return len(rows)
+
+
+def save_profiles(conn, user_ids, indptr, group_ids, norms):
+    """Сохраняет профили build_user_profiles: при следующих запросах их не нужно пересчитывать."""
+    rows = [(json.dumps(group_ids[indptr[i]:indptr[i + 1]].tolist()), float(norms[i]), int(uid))
+            for i, uid in enumerate(user_ids)]
+    with conn:
+        conn.executemany('UPDATE users SET emb_groups = ?, emb_norm = ? WHERE user_id = ?', rows)
+    return len(rows)
+
+
+def import_json(conn, json_path):
+    """Однократный перенос старого users.json в хранилище."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            data = []
+    return upsert_users(conn, data)
+
+
+def count_users(conn):
+    return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+
+def stored_user_ids(conn):
+    """Все user_id хранилища (для заполнения harvest_state.SeenIndex)."""
+    return [r[0] for r in conn.execute('SELECT user_id FROM users')]
+
+
+def distinct_cities(conn):
+    """Список различных городов (по индексу, без чтения всей таблицы)."""
+    return [r[0] for r in conn.execute('SELECT DISTINCT city FROM users WHERE city IS NOT NULL')]
+
+
+def _where(min_age=None, max_age=None, sex=None, city=None, today=None):
+    """SQL-условие для фильтров filtering.parse_query_filters."""
+    today = today or date.today()
+    clauses, params = [], []
+    if min_age is not None:
+        clauses.append('birth_date <= ?')
+        params.append(_years_ago(today, min_age).isoformat())
+    if max_age is not None:
+        # возраст <= max_age  ⇔  родился позже, чем (max_age + 1) лет назад
+        clauses.append('birth_date > ?')
+        params.append(_years_ago(today, max_age + 1).isoformat())
+    if sex is not None:
+        clauses.append('sex = ?')
+        params.append(SEX_CODES.get(sex, sex))
+    if city:
+        clauses.append("city LIKE '%' || ? || '%'")
+        params.append(city)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+def iter_users(conn, min_age=None, max_age=None, sex=None, city=None,
+               with_groups=True, chunksize=50_000):
+    """
+    Потоковое чтение пользователей DataFrame-чанками. Фильтры по возрасту,
+    полу и городу выполняются в SQLite (по индексам), так что читаются
+    только подходящие строки.
+    """
+    where, params = _where(min_age, max_age, sex, city)
+    columns = 'user_id, bdate, sex, city, country' + (', groups, emb_groups, emb_norm' if with_groups else '')
+    for chunk in pd.read_sql_query(f'SELECT {columns} FROM users{where}', conn,
+                                   params=params, chunksize=chunksize):
+        if with_groups:
+            chunk['groups'] = chunk['groups'].map(json.loads)
+            chunk['emb_groups'] = chunk['emb_groups'].map(json.loads, na_action='ignore')
+        yield chunk
+
+
+def users_by_id(conn, user_ids):
+    """Пользователи с данными user_id (без подписок) одним DataFrame."""
+    ids = [int(u) for u in user_ids]
+    return pd.read_sql_query(f"SELECT user_id, bdate, sex, city, country FROM users "
+                             f"WHERE user_id IN ({','.join('?' * len(ids))})", conn, params=ids)
+
+
+def load_users(conn, **filters):
+    """Все подходящие пользователи одним DataFrame (см. iter_users)."""
+    chunks = list(iter_users(conn, **filters))
+    if not chunks:
+        return pd.DataFrame(columns=['user_id', 'bdate', 'sex', 'city', 'country', 'groups',
+                                     'emb_groups', 'emb_norm'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def open_store_with_import(path='users.db', json_path='users.json'):
+    """Открывает хранилище; если его ещё не было, а есть users.json — импортирует его."""
+    existed = os.path.exists(path)
+    conn = open_store(path)
+    if not existed and os.path.isfile(json_path):
+        import_json(conn, json_path)
+    return conn
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+# TTL ответов по методам VK API (секунды): подписки меняются редко,
+# состав участников групп — часто
+METHOD_TTLS = {
+    'users.getSubscriptions': 7 * 24 * 3600,
+    'groups.getById':         30 * 24 * 3600,
+    'groups.getMembers':      3600,
+    'database.getCities':     30 * 24 * 3600,
+}
+DEFAULT_TTL = 3600
+MAX_BYTES = 512 * 1024 * 1024
+TOUCH_BATCH = 256  # сколько попаданий копить в памяти до записи accessed одним executemany
+
+_EXECUTE_METHOD_RE = re.compile(r'API\.([\w.]+)\(')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key      TEXT PRIMARY KEY,
+    method   TEXT,
+    value    BLOB,
+    size     INTEGER,
+    expires  REAL,
+    accessed REAL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed);
+'''
+
+
+def method_ttl(method, values, ttls=METHOD_TTLS):
+    """TTL вызова; для execute — минимальный TTL среди методов внутри кода."""
+    if method == 'execute':
+        inner = _EXECUTE_METHOD_RE.findall((values or {}).get('code', ''))
+        return min((ttls.get(m, DEFAULT_TTL) for m in inner), default=DEFAULT_TTL)
+    return ttls.get(method, DEFAULT_TTL)
+
+
+def cache_key(method, values, raw=False):
+    params = {k: v for k, v in (values or {}).items() if k not in ('access_token', 'v')}
+    payload = json.dumps([method, params, bool(raw)], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class VkResponseCache:
+    """
+    Персистентный кэш ответов VK API в SQLite: TTL по методам и
+    LRU-вытеснение при превышении max_bytes. Ответы хранятся как сжатый JSON.
+    Время последнего обращения при попадании копится в памяти и пишется в базу
+    пачкой — в put(), перед вытеснением или каждые TOUCH_BATCH попаданий, —
+    а не отдельным UPDATE с коммитом на каждый get().
+    Ведёт счётчики hit/miss (общие и по методам).
+    """
+
+    def __init__(self, path='vk_cache.db', max_bytes=MAX_BYTES, ttls=None):
+        self.max_bytes = max_bytes
+        self.ttls = {**METHOD_TTLS, **(ttls or {})}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.touched = {}  # key -> время последнего попадания, ещё не записанное в базу
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+
+    def get(self, method, values, raw=False):
+        """Ответ из кэша или None (нет записи / истёк TTL)."""
+        key = cache_key(method, values, raw)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < now:
+                self.misses[method] += 1
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= TOUCH_BATCH:
+                with self.conn:
+                    self._write_touched()
+            self.hits[method] += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, method, values, response, raw=False):
+        key = cache_key(method, values, raw)
+        blob = zlib.compress(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+        now = time.time()
+        with self.lock, self.conn:
+            self.touched.pop(key, None)
+            self._write_touched()
+            old = self.conn.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (key, method, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, method, blob, len(blob), now + method_ttl(method, values, self.ttls), now)
+            )
+            self.total_bytes += len(blob) - (old[0] if old else 0)
+            self._evict()
+
+    def _write_touched(self):
+        """Записывает накопленные времена обращений; вызывается под self.lock внутри транзакции."""
+        if self.touched:
+            self.conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                  [(t, key) for key, t in self.touched.items()])
+            self.touched.clear()
+
+    def flush(self):
+        with self.lock, self.conn:
+            self._write_touched()
+
+    def _evict(self):
+        """Сначала удаляем истёкшие записи, затем давно не использованные — пока не уложимся в бюджет."""
+        if self.total_bytes <= self.max_bytes:
+            return
+        self.conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        victims = []
+        excess = self.total_bytes - self.max_bytes
+        for key, size in self.conn.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            if excess <= 0:
+                break
+            victims.append((key,))
+            excess -= size
+        self.conn.executemany('DELETE FROM cache WHERE key = ?', victims)
+        self.total_bytes = self.max_bytes + excess
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM cache')
+            self.touched.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Метрики кэша: hit/miss, доля попаданий, размер."""
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'bytes': self.total_bytes,
+            'by_method': {m: {'hits': self.hits[m], 'misses': self.misses[m]}
+                          for m in sorted(set(self.hits) | set(self.misses))},
+        }
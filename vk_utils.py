@@ -1,101 +1,499 @@
-import vk_api
 import random
+import itertools
+import math
+import os
+import json
+import threading
+import time
+from collections import deque
+
+from vk_cache import VkResponseCache
+from tracing import span, count
+
 
 VK_TOKEN = ''
+VK_TOKENS = [VK_TOKEN]  # можно указать несколько токенов — запросы пойдут по кругу
+
+VK_RATE_PER_TOKEN = 3        # лимит VK: запросов в секунду на пользовательский токен
+RATE_LIMIT_CODES = {6, 9}    # "Too many requests per second", "Flood control"
+PERMANENT_ERRORS = {30}      # "Profile is private": повтор запроса ответа не изменит — такие ошибки кэшируем
+EXECUTE_BATCH = 25           # максимум вызовов API внутри одного execute
+MEMBER_FIELDS = ['bdate', 'sex', 'city', 'country', 'deactivated', 'is_closed', 'can_access_closed', 'photo_100', 'last_seen']
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5           # секунд, удваивается с каждой попыткой
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: не более rate запросов в секунду (по умолчанию без всплесков)."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or 1
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            time.sleep(wait_for)
+
+
+class _ApiMethod:
+    """Цепочка атрибутов вида api.users.getSubscriptions(...), как у vk_api.VkApiMethod."""
+
+    def __init__(self, pool, name):
+        self._pool = pool
+        self._name = name
+
+    def __getattr__(self, item):
+        return _ApiMethod(self._pool, f"{self._name}.{item}")
+
+    def __call__(self, **kwargs):
+        for k, v in kwargs.items():
+            if isinstance(v, (list, tuple)):
+                kwargs[k] = ','.join(str(x) for x in v)
+        return self._pool.method(self._name, kwargs)
+
+
+class VkApiPool:
+    """
+    Пул VK-сессий с round-robin по токенам, token bucket на каждый токен
+    и повтором с экспоненциальной задержкой при ошибках rate limit.
+    Интерфейс совпадает с vk_session.get_api(): pool.groups.getMembers(...).
+
+    vk_api.VkApi.method держит блокировку сессии на всё время HTTP-запроса,
+    так что запросы по одному токену идут строго последовательно, сколько бы
+    потоков их ни отправляло; параллельность сбора — это число токенов.
+    """
+
+    def __init__(self, sessions, rate=VK_RATE_PER_TOKEN):
+        self.sessions = list(sessions)
+        self.buckets = [TokenBucket(rate) for _ in self.sessions]
+        self._cycle = itertools.cycle(range(len(self.sessions)))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_tokens(cls, tokens, rate=VK_RATE_PER_TOKEN):
+        import requests
+        import vk_api
+
+        # одно HTTP-соединение (keep-alive) на все токены; собственная пауза vk_api
+        # между запросами (RPS_DELAY) не нужна — темп держит token bucket пула
+        http = requests.Session()
+        sessions = [vk_api.VkApi(token=t, session=http) for t in tokens]
+        for session in sessions:
+            session.RPS_DELAY = 0
+        return cls(sessions, rate=rate)
+
+    def method(self, name, values=None, raw=False):
+        import vk_api
+        for attempt in range(MAX_RETRIES + 1):
+            with self._lock:
+                i = next(self._cycle)
+            with span('vk.rate_wait'):
+                self.buckets[i].acquire()
+            count('vk.calls')
+            try:
+                with span('vk.' + name):
+                    return self.sessions[i].method(name, values, raw=raw)
+            except vk_api.exceptions.ApiError as e:
+                if e.code not in RATE_LIMIT_CODES or attempt == MAX_RETRIES:
+                    count('vk.errors')
+                    raise
+                count('vk.rate_limited')
+                time.sleep(BACKOFF_BASE * 2 ** attempt)
+
+    def __getattr__(self, item):
+        return _ApiMethod(self, item)
+
+
+class CachedVkApi:
+    """
+    Обёртка над VkApiPool (или vk_api.VkApi) с персистентным кэшем ответов
+    (vk_cache.VkResponseCache). bypass=True — не читать из кэша
+    (ответы всё равно записываются, обновляя кэш).
+    Вызовы внутри execute (vk_execute) кэшируются по отдельности — см. execute().
+    """
+
+    def __init__(self, api, cache, bypass=False):
+        self.api = api
+        self.cache = cache
+        self.bypass = bypass
+
+    def method(self, name, values=None, raw=False):
+        if not self.bypass:
+            cached = self.cache.get(name, values, raw)
+            if cached is not None:
+                count('vk.cache_hit')
+                return cached
+        count('vk.cache_miss')
+        response = self.api.method(name, values, raw=raw)
+        self.cache.put(name, values, response, raw)
+        return response
+
+    def execute(self, method, calls):
+        """
+        vk_execute с кэшем по каждому вызову: ключ — method и параметры вызова,
+        поэтому TTL и метрики — по методу, а подписки пользователя находятся
+        в кэше, в какой бы пачке он ни попался. В execute уходят только промахи.
+        Кэшируются успешные результаты и постоянные ошибки (PERMANENT_ERRORS);
+        временные (лимиты, внутренние ошибки VK) при следующем запуске повторяются.
+        """
+        out = [None] * len(calls)
+        missing = []
+        for i, call in enumerate(calls):
+            # raw=True отделяет эти записи от прямых вызовов method с теми же параметрами
+            cached = None if self.bypass else self.cache.get(method, call, raw=True)
+            if cached is None:
+                missing.append(i)
+            else:
+                out[i] = (cached.get('result'), cached.get('error'))
+        count('vk.cache_hit', len(calls) - len(missing))
+        count('vk.cache_miss', len(missing))
+        if missing:
+            results = _execute(method, [calls[i] for i in missing], self.api)
+            for i, (result, error) in zip(missing, results):
+                out[i] = (result, error)
+                if error is None:
+                    self.cache.put(method, calls[i], {'result': result}, raw=True)
+                elif error.get('error_code') in PERMANENT_ERRORS:
+                    self.cache.put(method, calls[i], {'error': error}, raw=True)
+        return out
+
+    def __getattr__(self, item):
+        return _ApiMethod(self, item)
+
+
+VK_CACHE_PATH = 'vk_cache.db'
+VK_CACHE_BYPASS = os.environ.get('VK_CACHE_BYPASS') == '1'
+
+vk = None  # общий клиент; создаётся get_vk() при первом запросе
+_vk_lock = threading.Lock()
+
+
+def get_vk():
+    """Общий клиент VK (пул токенов + кэш ответов), создаётся при первом обращении."""
+    global vk
+    if vk is None:
+        with _vk_lock:
+            if vk is None:
+                vk = CachedVkApi(VkApiPool.from_tokens(VK_TOKENS), VkResponseCache(VK_CACHE_PATH),
+                                 bypass=VK_CACHE_BYPASS)
+    return vk
 
-vk_session = vk_api.VkApi(token=VK_TOKEN)
-vk = vk_session.get_api()
-
-
-def get_group_members_count(group_id):
-    """Получить количество участников группы."""
-    try:
-        info = vk.groups.getMembers(group_id=group_id)
-        return info['count']
-    except vk_api.exceptions.ApiError as e:
-        print(f"Ошибка при получении количества участников группы {group_id}: {e}")
-        return 0
-    
-
-def vk_get_group_members(group_id, offset=1000, count=100):
-    try:
-        members = vk.groups.getMembers(
-            group_id=group_id,
-            offset=offset,
-            count=count,
-            fields=['bdate', 'sex', 'city', 'country', 'deactivated', 'is_closed', 'can_access_closed', 'photo_100', 'last_seen']
-        )
-        # Фильтруем только живых и открытых
-        filtered = []
-        for u in members['items']:
-            if u.get('deactivated'):
+
+def _alive_members(items):
+    """Фильтруем только живых и открытых."""
+    filtered = []
+    for u in items:
+        if u.get('deactivated'):
+            continue
+        if u.get('is_closed') and not u.get('can_access_closed'):
+            continue
+        filtered.append(u)
+    return filtered
+
+
+def _filter_groups(items):
+    processed_groups = []
+    for item_dict in items[:30]: # item_dict - это полный словарь группы от VK API
+        # Создаем новый словарь только с нужными полями
+        processed_groups.append({
+            'id': item_dict.get('id'),
+            'name': item_dict.get('name'),
+            'status': item_dict.get('status')
+        })
+    return processed_groups
+
+
+def vk_execute(method, calls, api=None):
+    """
+    Выполняет до EXECUTE_BATCH вызовов method одним запросом execute.
+    calls — список словарей параметров. Возвращает список пар (result, error)
+    в том же порядке; для неудачного вызова result = None, а error — словарь
+    ошибки VK (error_code, error_msg) из execute_errors.
+    """
+    api = api or get_vk()
+    if len(calls) > EXECUTE_BATCH:
+        raise ValueError(f"execute принимает не больше {EXECUTE_BATCH} вызовов")
+    if isinstance(api, CachedVkApi):
+        return api.execute(method, calls)
+    return _execute(method, calls, api)
+
+
+def _execute(method, calls, api):
+    code = 'return [' + ','.join(
+        f'API.{method}({json.dumps(c, ensure_ascii=False)})' for c in calls
+    ) + '];'
+    response = api.method('execute', {'code': code}, raw=True)
+    results = response.get('response') or [False] * len(calls)
+    # execute_errors перечисляет ошибки в порядке неудачных вызовов
+    errors = iter(response.get('execute_errors', []))
+    out = []
+    for result in results:
+        if result is False:
+            out.append((None, next(errors, {'error_code': None, 'error_msg': 'unknown error'})))
+        else:
+            out.append((result, None))
+    return out
+
+
+def vk_get_group_members_pages(group_id, offsets, count=1000, api=None):
+    """
+    Страницы groups.getMembers для нескольких offset пачками по EXECUTE_BATCH
+    в одном execute. Возвращает (count, живые участники со всех страниц).
+    """
+    import vk_api
+    api = api or get_vk()
+    total = 0
+    members = []
+    fields = ','.join(MEMBER_FIELDS)
+    offsets = list(offsets)
+    for start in range(0, len(offsets), EXECUTE_BATCH):
+        calls = [{'group_id': group_id, 'offset': off, 'count': count, 'fields': fields}
+                 for off in offsets[start:start + EXECUTE_BATCH]]
+        try:
+            results = vk_execute('groups.getMembers', calls, api)
+        except vk_api.exceptions.ApiError as e:
+            print(f"Ошибка при получении участников группы {group_id}: {e}")
+            continue
+        for result, error in results:
+            if error:
+                print(f"Ошибка при получении участников группы {group_id}: [{error.get('error_code')}] {error.get('error_msg')}")
                 continue
-            if u.get('is_closed') and not u.get('can_access_closed'):
+            total = result.get('count', total)
+            members.extend(_alive_members(result.get('items', [])))
+    return total, members
+
+
+def vk_find_cities(words, country_id=1, api=None):
+    """
+    Названия городов справочника VK (database.getCities), найденных по словам
+    запроса, — одним execute на EXECUTE_BATCH слов. При ошибке API — что успели найти.
+    """
+    import vk_api
+    api = api or get_vk()
+    words = list(dict.fromkeys(words))
+    titles = []
+    for start in range(0, len(words), EXECUTE_BATCH):
+        calls = [{'country_id': country_id, 'q': w, 'need_all': 1, 'count': 20}
+                 for w in words[start:start + EXECUTE_BATCH]]
+        try:
+            results = vk_execute('database.getCities', calls, api)
+        except vk_api.exceptions.ApiError as e:
+            print(f"Ошибка при поиске городов: {e}")
+            continue
+        for result, error in results:
+            if result:
+                titles.extend(item['title'] for item in result.get('items', []))
+    return list(dict.fromkeys(titles))
+
+
+def get_users_groups_batch(user_ids, api=None, private=None):
+    """
+    Подписки для нескольких пользователей: по EXECUTE_BATCH вызовов
+    users.getSubscriptions в одном execute. Возвращает dict user_id → список
+    групп {id, name, status} или None (приватный профиль, ошибка).
+    В множество private (если передано) добавляются id закрытых профилей.
+    """
+    import vk_api
+    api = api or get_vk()
+    user_ids = list(user_ids)
+    result = {}
+    for start in range(0, len(user_ids), EXECUTE_BATCH):
+        chunk = user_ids[start:start + EXECUTE_BATCH]
+        calls = [{'user_id': uid, 'extended': 1, 'fields': 'name,status'} for uid in chunk]
+        try:
+            responses = vk_execute('users.getSubscriptions', calls, api)
+        except vk_api.exceptions.ApiError as e:
+            print(f"Ошибка при пакетном получении подписок: {e}")
+            result.update((uid, None) for uid in chunk)
+            continue
+        for uid, (response, error) in zip(chunk, responses):
+            if error:
+                count('vk.users_private' if error.get('error_code') == 30 else 'vk.errors')
+                if error.get('error_code') == 30:  # 30 — Profile is private
+                    if private is not None:
+                        private.add(uid)
+                else:
+                    print(f"Ошибка при получении групп пользователя {uid}: [{error.get('error_code')}] {error.get('error_msg')}")
+                result[uid] = None
+            else:
+                result[uid] = _filter_groups(response.get('items', []))
+    return result
+
+
+def make_user_record(u, groups_info):
+    return {
+        "user_id": u["id"],
+        "bdate":   u.get("bdate"),
+        "sex":     u.get("sex"),
+        "city":    u.get("city", {}).get("title"),
+        "country": u.get("country", {}).get("title"),
+        "groups": groups_info
+    }
+
+
+class MemberSampler:
+    """
+    Стратифицированная выборка участников из нескольких групп.
+    Первый раунд — одна страница с начала каждой группы: count и участники
+    приходят одним запросом (execute на все группы). По ней оцениваем долю
+    живых/открытых профилей в группе. Следующие раунды добирают недостающее:
+    остаток квоты делится поровну между группами, а число страниц на группу
+    считается по её доле живых и по наблюдаемой доле открытых подписок.
+    Страницы берутся из разных частей списка участников (страты) и не
+    повторяются. iter_pages() отдаёт страницы живых участников вперемешку
+    по группам; record() сообщает, сколько из выданных оказались пригодными.
+    predicate(members) → подходящие участники (например, filtering.filter_members
+    по полу/возрасту/городу запроса) применяется к странице до запроса подписок;
+    число страниц тогда считается и с учётом доли подходящих.
+    state()/restore() — снимок для чекпоинта: после restore() iter_pages()
+    продолжает с невыданных страниц и следующего раунда, не повторяя запросов.
+    """
+
+    def __init__(self, groups, n_target, page_size=100, max_rounds=4,
+                 subscription_yield=0.7, seed=None, api=None, predicate=None):
+        self.groups = list(dict.fromkeys(groups))
+        self.n_target = n_target
+        self.page_size = page_size
+        self.max_rounds = max_rounds
+        self.api = api or get_vk()
+        self.rng = random.Random(seed)
+        self.counts = {}                 # gid → число участников
+        self.used_pages = {}             # gid → номера уже взятых страниц
+        self.fetched = {}                # gid → сколько участников получено
+        self.alive = {}                  # gid → сколько из них живых/открытых
+        self.matching = {}               # gid → сколько живых прошли predicate
+        self.predicate = predicate
+        self.checked = 0
+        self.usable = 0
+        self.prior_yield = subscription_yield
+        self.round = 0                   # сколько раундов уже запрошено
+        self.buffer = deque()            # полученные, но ещё не выданные страницы
+
+    @property
+    def subscription_yield(self):
+        """Доля пользователей с доступными подписками (сглаженная оценка)."""
+        return (self.usable + 10 * self.prior_yield) / (self.checked + 10)
+
+    def record(self, checked, usable):
+        self.checked += checked
+        self.usable += usable
+
+    def _alive_yield(self, gid):
+        return (self.alive.get(gid, 0) + 1) / (self.fetched.get(gid, 0) + 2)
+
+    def _match_yield(self, gid):
+        if self.predicate is None:
+            return 1.0
+        return (self.matching.get(gid, 0) + 1) / (self.alive.get(gid, 0) + 2)
+
+    def _match(self, gid, members):
+        """Оставляет участников, подходящих под predicate, и учитывает их долю в группе."""
+        if self.predicate is not None:
+            matched = self.predicate(members)
+            count('vk.members_filtered', len(members) - len(matched))
+            members = matched
+        self.matching[gid] = self.matching.get(gid, 0) + len(members)
+        return members
+
+    def _first_pages(self):
+        import vk_api
+        fields = ','.join(MEMBER_FIELDS)
+        pages = {}
+        for start in range(0, len(self.groups), EXECUTE_BATCH):
+            chunk = self.groups[start:start + EXECUTE_BATCH]
+            calls = [{'group_id': gid, 'offset': 0, 'count': self.page_size, 'fields': fields} for gid in chunk]
+            try:
+                results = vk_execute('groups.getMembers', calls, self.api)
+            except vk_api.exceptions.ApiError as e:
+                print(f"Ошибка при получении участников групп: {e}")
                 continue
-            filtered.append(u)
-        return filtered
-    except vk_api.exceptions.ApiError as e:
-        print(f"Ошибка при получении участников группы {group_id}: {e}")
-        return []
-    
-def get_user_groups(user_id):
-    try:
-        response = vk.users.getSubscriptions(
-            user_id=user_id,
-            extended=1,
-            fields=['name', 'status']  # Запрашиваем name и status
-        )
-        
-        items = response.get('items', []) # Получаем список групп, по умолчанию пустой список
-        
-        processed_groups = []
-        for item_dict in items[:30]: # item_dict - это полный словарь группы от VK API
-            # Создаем новый словарь только с нужными полями
-            filtered_group_info = {
-                'id': item_dict.get('id'),
-                'name': item_dict.get('name'),
-                'status': item_dict.get('status')
-            }
-            # print(filtered_group_info)
-            processed_groups.append(filtered_group_info)
-            
-        return processed_groups # Возвращаем список отфильтрованных словарей
-        
-    except vk_api.exceptions.ApiError as e:
-        if e.code == 30:  # Profile is private
-            return None
-        print(f"Ошибка при получении групп пользователя {user_id}: {e}")
-        return None
-    except Exception as e: # Отлов других возможных ошибок
-        print(f"Неожиданная ошибка при обработке подписок для пользователя {user_id}: {e}")
-        return None
-
-
-def collect_alive_users_from_groups(groups, n_target=100):
-    users = []
-    checked = 0
-    for gid in groups:
-        total = get_group_members_count(gid)
-        print('Обработана группа')
-        offset = random.randint(0, max(0, total-1000))
-        members = vk_get_group_members(gid, offset=offset, count=100)
-        print('Собрано человек:', len(members))
-        for u in members:
-            # Проверяем, не набрали ли уже нужное количество
-            if len(users) >= n_target:
-                return users
-            # Пробуем получить группы пользователя
-            groups_info = get_user_groups(u["id"])
-            checked += 1
-            if groups_info is None:
-                continue  # Пропускаем удалённых/закрытых/забаненных
-            users.append({
-                "user_id": u["id"],
-                "bdate":   u.get("bdate"),
-                "sex":     u.get("sex"),
-                "city":    u.get("city", {}).get("title"),
-                "country": u.get("country", {}).get("title"),
-                "groups": groups_info
-            })
-    print(f"Проверено пользователей: {checked}, собрано живых: {len(users)}")
-    return users
\ No newline at end of file
+            for gid, (result, error) in zip(chunk, results):
+                if error:
+                    print(f"Ошибка при получении участников группы {gid}: [{error.get('error_code')}] {error.get('error_msg')}")
+                    continue
+                items = result.get('items', [])
+                self.counts[gid] = result.get('count', 0)
+                self.used_pages[gid] = {0}
+                pages[gid] = self._match(gid, self._account(gid, items))
+        return pages
+
+    def _account(self, gid, items):
+        alive = _alive_members(items)
+        self.fetched[gid] = self.fetched.get(gid, 0) + len(items)
+        self.alive[gid] = self.alive.get(gid, 0) + len(alive)
+        return alive
+
+    def _pick_pages(self, gid, n_pages):
+        """n_pages ещё не взятых страниц, по одной из равных страт списка участников."""
+        total_pages = -(-self.counts[gid] // self.page_size)
+        free = [p for p in range(total_pages) if p not in self.used_pages[gid]]
+        if len(free) <= n_pages:
+            return free
+        width = len(free) / n_pages
+        return [free[int(i * width) + self.rng.randrange(max(1, int(width)))] for i in range(n_pages)]
+
+    def _next_round(self):
+        remaining = self.n_target - self.usable
+        active = [g for g in self.counts
+                  if len(self.used_pages[g]) * self.page_size < self.counts[g]]
+        if remaining <= 0 or not active:
+            return {}
+        quota = remaining / len(active)
+        pages = {}
+        for gid in active:
+            expected_per_page = (self.page_size * self._alive_yield(gid) * self._match_yield(gid)
+                                 * self.subscription_yield)
+            n_pages = max(1, math.ceil(quota / max(expected_per_page, 1e-3)))
+            chosen = self._pick_pages(gid, n_pages)
+            self.used_pages[gid].update(chosen)
+            total, members = vk_get_group_members_pages(
+                gid, [p * self.page_size for p in chosen], count=self.page_size, api=self.api)
+            # для учёта доли живых нужен и размер «сырых» страниц
+            self.fetched[gid] = self.fetched.get(gid, 0) + sum(
+                min(self.page_size, self.counts[gid] - p * self.page_size) for p in chosen)
+            self.alive[gid] = self.alive.get(gid, 0) + len(members)
+            pages[gid] = self._match(gid, members)
+        return pages
+
+    def iter_pages(self):
+        """Страницы живых участников; группы чередуются, чтобы квота распределялась между ними."""
+        while True:
+            if not self.buffer:
+                if self.round >= self.max_rounds:
+                    return
+                pages = self._first_pages() if self.round == 0 else self._next_round()
+                self.round = self.round + 1 if pages else self.max_rounds
+                per_group = {gid: [m[i:i + self.page_size] for i in range(0, len(m), self.page_size)]
+                             for gid, m in pages.items()}
+                for chunk in itertools.zip_longest(*per_group.values()):
+                    self.buffer.extend(members for members in chunk if members)
+                continue
+            yield self.buffer.popleft()
+
+    def state(self):
+        # снимок может сниматься из другого потока, пока идёт раунд: копируем целиком, без итерации по живым dict
+        per_group = {'counts': self.counts, 'fetched': self.fetched, 'alive': self.alive, 'matching': self.matching}
+        state = {name: {str(gid): v for gid, v in dict(d).items()} for name, d in per_group.items()}
+        state['used_pages'] = {str(gid): sorted(pages) for gid, pages in dict(self.used_pages).items()}
+        state.update(round=self.round, checked=self.checked, usable=self.usable, buffer=list(self.buffer))
+        return state
+
+    def restore(self, state):
+        # ключи JSON — строки, группы могут быть заданы и числом, и коротким именем
+        by_key = {str(gid): gid for gid in self.groups}
+        for name in ('counts', 'fetched', 'alive', 'matching'):
+            setattr(self, name, {by_key[k]: v for k, v in state[name].items() if k in by_key})
+        self.used_pages = {by_key[k]: set(v) for k, v in state['used_pages'].items() if k in by_key}
+        self.round, self.checked, self.usable = state['round'], state['checked'], state['usable']
+        self.buffer = deque(state['buffer'])
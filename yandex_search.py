@@ -1,10 +1,78 @@
-import requests
+import hashlib
+import os
+import re
+import threading
+import time
+import urllib.parse
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fs_utils import atomic_write
+from tracing import span, count
 
 YANDEX_FOLDER_ID = ''
 YANDEX_API_KEY   = ''
+YANDEX_SEARCH_URL = "https://yandex.ru/search/xml"
+
+CACHE_DIR = 'yandex_cache'
+CACHE_TTL = 24 * 3600  # секунд
+NO_RESULTS_CODES = {'15'}  # «ничего не найдено» — настоящий ответ, его можно кэшировать
+
+# vk.com/club123, vk.com/public123, vk.com/event123 → 123
+_GROUP_PATH_RE = re.compile(r'^/(?:club|public|event)(\d+)/?$')
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Один requests.Session на процесс — соединения переиспользуются."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                _session.mount('https://', adapter)
+                _session.mount('http://', adapter)
+    return _session
+
+
+class YandexSearchError(Exception):
+    """Ошибка Яндекс XML (квота, RPS, авторизация), пришедшая внутри ответа с HTTP 200."""
+
+    def __init__(self, code, message):
+        super().__init__(f"[{code}] {message}")
+        self.code = code
+
+
+def check_response(xml_text):
+    """YandexSearchError, если в ответе <error> (кроме «ничего не найдено»)."""
+    error = ET.fromstring(xml_text).find('.//response/error')
+    if error is not None and error.get('code') not in NO_RESULTS_CODES:
+        raise YandexSearchError(error.get('code'), (error.text or '').strip())
+
+
+def _cache_path(query, page, cache_dir):
+    key = hashlib.sha1(f"{query}\n{page}".encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.xml')
+
+
+def fetch_page(query, page=0, url=YANDEX_SEARCH_URL, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """
+    XML-ответ Яндекса для (query, page). Ответы кэшируются на диске на ttl секунд;
+    cache_dir=None отключает кэш. Ошибки Яндекса в теле ответа (квота, RPS,
+    ключ) поднимаются как YandexSearchError и не кэшируются.
+    """
+    path = _cache_path(query, page, cache_dir) if cache_dir else None
+    if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl:
+        count('yandex.cache_hit')
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    count('yandex.cache_miss')
 
-def yandex_search_vk_groups(query, page=0):
     params = {
         "folderid": YANDEX_FOLDER_ID,
         "apikey":   YANDEX_API_KEY,
@@ -13,8 +81,53 @@ def yandex_search_vk_groups(query, page=0):
         "page":     page,
         "groupby":  "attr=d.mode=deep.groups-on-page=5.docs-in-group=3",
     }
-    r = requests.get("https://yandex.ru/search/xml", params=params)
-    # print("Ответ Яндекса:", r.text[:500]) 
-    r.raise_for_status()
-    root = ET.fromstring(r.text)
-    return [u.text for u in root.findall(".//doc/url")]
\ No newline at end of file
+    with span('yandex.fetch_page', page=page):
+        count('yandex.calls')
+        r = get_session().get(url, params=params, timeout=30)
+        r.raise_for_status()
+    check_response(r.text)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(path) as f:
+            f.write(r.text)
+    return r.text
+
+
+def parse_urls(xml_text):
+    root = ET.fromstring(xml_text)
+    return [u.text for u in root.findall(".//doc/url")]
+
+
+def parse_group_id(url):
+    """ID группы из ссылки VK или None, если ссылка не на club/public/event."""
+    m = _GROUP_PATH_RE.match(urllib.parse.urlparse(url or '').path)
+    return int(m.group(1)) if m else None
+
+
+def yandex_search_vk_groups(query, page=0, **kwargs):
+    return parse_urls(fetch_page(query, page, **kwargs))
+
+
+def search_vk_groups(queries, pages=3, workers=8, **kwargs):
+    """
+    Ищет группы VK по всем вариантам запроса и первым pages страницам
+    одновременно. Возвращает (urls, group_ids) без повторов, в порядке выдачи.
+    Ошибки отдельных страниц не прерывают поиск.
+    """
+    queries = list(dict.fromkeys(q for q in queries if q))
+    jobs = [(q, p) for q in queries for p in range(pages)]
+
+    def run(job):
+        try:
+            return yandex_search_vk_groups(job[0], job[1], **kwargs)
+        except (requests.RequestException, ET.ParseError, YandexSearchError) as e:
+            count('yandex.errors')
+            print(f"Ошибка поиска Яндекса для «{job[0]}», страница {job[1]}: {e}")
+            return []
+
+    with span('yandex.search', jobs=len(jobs)), ThreadPoolExecutor(max_workers=workers) as pool:
+        pages_urls = list(pool.map(run, jobs))
+
+    urls = list(dict.fromkeys(u for page_urls in pages_urls for u in page_urls))
+    group_ids = list(dict.fromkeys(g for g in map(parse_group_id, urls) if g is not None))
+    return urls, group_ids